@@ -0,0 +1,71 @@
+"""
+Lookup cost of HostRoutingResolver as the rule table grows, with and
+without the memoized host cache.
+
+    PYTHONPATH=. python bench/bench_host_routing.py [num_lookups]
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from wsgiprox.resolvers import HostRoutingResolver
+
+
+# ============================================================================
+def make_rules(num_rules):
+    rules = []
+    for i in range(num_rules):
+        if i % 2:
+            rules.append(('.domain-{0}.example.com'.format(i), '/coll-{0}/'.format(i)))
+        else:
+            rules.append(('host-{0}.example.org'.format(i), '/coll-{0}/'.format(i)))
+
+    # a few url pattern rules
+    rules.append((r're:https?://[^/]+/api/v\d+/', '/api/'))
+    rules.append((r're:https?://cdn\.[^/]+/static/', '/static/'))
+    return rules
+
+
+def make_urls(num_rules, count):
+    urls = []
+    for _ in range(count):
+        i = random.randrange(num_rules)
+        if i % 2:
+            host = 'www.domain-{0}.example.com'.format(i)
+        else:
+            host = 'host-{0}.example.org'.format(i)
+
+        urls.append('https://{0}/path/page-{1}.html'.format(host, random.randrange(100)))
+
+    return urls
+
+
+def run(num_rules, num_lookups, cache_size):
+    resolver = HostRoutingResolver(make_rules(num_rules), cache_size=cache_size)
+
+    # draw from a bounded set of hosts, like a real browsing session
+    urls = make_urls(num_rules, 2000)
+
+    start = time.time()
+    for i in range(num_lookups):
+        resolver(urls[i % len(urls)], {})
+
+    return (time.time() - start) / num_lookups * 1e6
+
+
+def main():
+    num_lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    for num_rules in (10, 100, 1000, 10000, 100000):
+        uncached = run(num_rules, num_lookups, 0)
+        cached = run(num_rules, num_lookups, 10000)
+
+        print('{0:>7} rules: {1:.2f} us/lookup uncached, {2:.2f} us/lookup cached'.format(
+              num_rules, uncached, cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Memory held per idle keep-alive tunnel: opens N socketpair 'tunnels',
+runs one request through each ConnectHandler and leaves them waiting for
+the next request line, then reports traced memory per tunnel.
+
+Compares the pooled reader with the previous per-tunnel io.BufferedReader.
+
+    PYTHONPATH=. python bench/bench_idle_tunnels.py [num_tunnels] [buffer_size]
+"""
+
+from __future__ import print_function
+
+import io
+import socket
+import sys
+import tracemalloc
+
+from wsgiprox.wsgiprox import ConnectHandler, BufferPool, SocketReader
+
+
+REQUEST = b'GET /path HTTP/1.1\r\nHost: example.com\r\nConnection: keep-alive\r\n\r\n'
+
+
+# ============================================================================
+def app(environ, start_response):
+    start_response('200 OK', [('Content-Length', '2')])
+    return [b'OK']
+
+
+def resolve(url, env, hostname):
+    env['REQUEST_URI'] = url
+
+
+def run(num_tunnels, buff_size, legacy):
+    pool = BufferPool(buff_size)
+    env = {'wsgiprox.connect_host': 'example.com'}
+    tunnels = []
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+
+    for _ in range(num_tunnels):
+        server, client = socket.socketpair()
+        handler = ConnectHandler(server, 'https', app, resolve, pool)
+
+        if legacy:
+            # previous behavior: 16K BufferedReader held for tunnel lifetime
+            handler.reader = io.BufferedReader(SocketReader(server), buff_size)
+            handler.reader.release = lambda: None
+
+        client.sendall(REQUEST)
+        handler(env, False)
+        client.recv(4096)
+
+        tunnels.append((handler, server, client))
+
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for handler, server, client in tunnels:
+        server.close()
+        client.close()
+
+    return (end - start) / float(num_tunnels)
+
+
+def main():
+    num_tunnels = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    buff_size = int(sys.argv[2]) if len(sys.argv) > 2 else 16384
+
+    for name, legacy in (('per-tunnel', True), ('pooled', False)):
+        per_tunnel = run(num_tunnels, buff_size, legacy)
+        print('{0:>10}: {1:.0f} bytes per idle tunnel'.format(name, per_tunnel))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Worker startup cost: time to import wsgiprox.wsgiprox and construct a
+WSGIProxMiddleware, and peak memory, each measured in a fresh interpreter.
+
+Compares the default (tls set up on the first intercepted https tunnel)
+with preload_tls, which loads OpenSSL and the root CA up front.
+
+    PYTHONPATH=. python bench/bench_import.py [runs]
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+CHILD = """
+import json, resource, sys, time
+
+start = time.time()
+from wsgiprox.wsgiprox import WSGIProxMiddleware
+imported = time.time()
+
+app = WSGIProxMiddleware(lambda env, sr: [], '/',
+                         proxy_options={'ca_file_cache': sys.argv[1],
+                                        'preload_tls': sys.argv[2] == '1'})
+constructed = time.time()
+
+print(json.dumps({'import': imported - start,
+                  'init': constructed - imported,
+                  'openssl': 'OpenSSL' in sys.modules,
+                  'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+# ============================================================================
+def run(ca_file, preload):
+    out = subprocess.check_output([sys.executable, '-c', CHILD, ca_file,
+                                   '1' if preload else '0'])
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    ca_dir = tempfile.mkdtemp()
+    ca_file = os.path.join(ca_dir, 'ca.pem')
+
+    try:
+        # create the ca once, so the runs only measure loading it
+        run(ca_file, True)
+
+        for name, preload in (('deferred', False), ('preload_tls', True)):
+            results = [run(ca_file, preload) for _ in range(runs)]
+
+            print('{0:>12}: import {1:.1f}ms, init {2:.1f}ms, max rss {3}KB, OpenSSL loaded: {4}'.format(
+                  name,
+                  median([r['import'] for r in results]) * 1000,
+                  median([r['init'] for r in results]) * 1000,
+                  median([r['rss_kb'] for r in results]),
+                  results[0]['openssl']))
+
+    finally:
+        shutil.rmtree(ca_dir)
+
+
+if __name__ == '__main__':
+    main()
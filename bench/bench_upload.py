@@ -0,0 +1,84 @@
+"""
+Compare the inbound (request body) path of a tunnel with and without
+recv_into(): reads an upload through io.BufferedReader the way
+ConnectHandler does, and reports throughput and peak traced memory.
+
+    PYTHONPATH=. python bench/bench_upload.py [size_mb] [app_read_size]
+"""
+
+from __future__ import print_function
+
+import io
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+from wsgiprox.wsgiprox import SocketReader, BUFF_SIZE
+
+
+# ============================================================================
+class RecvOnlySocketReader(io.BufferedIOBase):
+    """ previous reader: only read() via recv(), copied by BufferedReader """
+    def __init__(self, socket):
+        self.socket = socket
+
+    def readable(self):
+        return True
+
+    def read(self, size):
+        return self.socket.recv(size)
+
+
+# ============================================================================
+def send_all(sock, total):
+    chunk = b'x' * 65536
+    sent = 0
+    while sent < total:
+        sock.sendall(chunk)
+        sent += len(chunk)
+    sock.close()
+
+
+def run(reader_cls, total, app_read_size):
+    server, client = socket.socketpair()
+    sender = threading.Thread(target=send_all, args=(client, total))
+
+    reader = io.BufferedReader(reader_cls(server), BUFF_SIZE)
+    buff = bytearray(app_read_size)
+
+    tracemalloc.start()
+    start = time.time()
+    sender.start()
+
+    read = 0
+    while read < total:
+        size = reader.readinto(buff)
+        if not size:
+            break
+        read += size
+
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    sender.join()
+    server.close()
+    return elapsed, peak
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    app_read_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+    total = size_mb * 1024 * 1024
+
+    for name, cls in (('recv', RecvOnlySocketReader),
+                      ('recv_into', SocketReader)):
+        elapsed, peak = run(cls, total, app_read_size)
+        print('{0:>10}: {1:.1f} MB/s, peak traced memory {2} bytes'.format(
+              name, size_mb / elapsed, peak))
+
+
+if __name__ == '__main__':
+    main()
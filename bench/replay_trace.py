@@ -0,0 +1,270 @@
+"""
+Replay a recorded trace of proxy traffic against a local WSGIProxMiddleware
+with a stand-in app, to benchmark with a realistic mix of hosts, keep-alive
+tunnels and body sizes.
+
+A trace is an access log, recorded from a running proxy with:
+
+    proxy_options={'access_log': 'trace.log'}
+
+Each tunnel in the trace is opened at its recorded time (divided by
+--speed, or all at once with --speed 0), with the same host and the same
+requests in order, sending and returning bodies of the recorded sizes.
+Plain http proxy requests are sent on their own connection. Pass-through
+tunnels are skipped.
+
+Reports throughput, request latency percentiles, and the number of tunnels
+opened through the proxy, of which TLS (each with its own handshake).
+
+    PYTHONPATH=. python bench/replay_trace.py trace.log [--speed 1.0] [--limit N]
+"""
+
+from __future__ import print_function
+
+from gevent.monkey import patch_all; patch_all()
+from gevent.pywsgi import WSGIServer
+
+import argparse
+import json
+import ssl
+import sys
+import tempfile
+import time
+import shutil
+import os
+
+import gevent
+
+from six.moves.http_client import HTTPConnection, HTTPSConnection
+from six.moves.urllib.parse import parse_qsl
+
+from wsgiprox.wsgiprox import WSGIProxMiddleware
+
+
+# ============================================================================
+def stand_in_app(env, start_response):
+    """ reads the request body, returns a body of the size requested """
+    params = dict(parse_qsl(env.get('QUERY_STRING', '')))
+
+    length = int(env.get('CONTENT_LENGTH') or 0)
+    if length:
+        env['wsgi.input'].read(length)
+
+    size = int(params.get('__size', 0))
+
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                              ('Content-Length', str(size))])
+    return [b'x' * size]
+
+
+# ============================================================================
+def load_trace(filename, limit=None):
+    """ group trace records into connections, each a list of requests
+    in order, sorted by start time """
+    conns = {}
+
+    with open(filename) as fh:
+        for num, line in enumerate(fh):
+            if limit and num >= limit:
+                break
+
+            record = json.loads(line)
+
+            # pass-through tunnels
+            if record['method'] == 'CONNECT':
+                continue
+
+            if record.get('tunnel') is not None:
+                key = ('tunnel', record['tunnel'])
+            else:
+                key = ('http', num)
+
+            conns.setdefault(key, []).append(record)
+
+    conns = list(conns.values())
+
+    for requests in conns:
+        requests.sort(key=lambda r: r.get('index') or 0)
+
+    conns.sort(key=lambda reqs: reqs[0]['time'])
+    return conns
+
+
+def get_port(record):
+    """ port of the original url, only kept in the resolved uri, as the
+    record host is the hostname only """
+    default = 443 if record.get('scheme') == 'https' else 80
+
+    uri = record.get('uri') or ''
+    prefix = '{0}://{1}:'.format(record.get('scheme'), record.get('host'))
+
+    pos = uri.find(prefix)
+    if pos < 0:
+        return default
+
+    port = uri[pos + len(prefix):].split('/', 1)[0].split('?', 1)[0]
+    return int(port) if port.isdigit() else default
+
+
+def get_path(record):
+    """ original path of the resolved uri, with the response size to return """
+    uri = record.get('uri') or '/'
+    prefix = '{0}://{1}'.format(record.get('scheme'), record.get('host'))
+
+    pos = uri.find(prefix)
+    if pos >= 0:
+        uri = uri[pos + len(prefix):]
+
+        # skip port, if any
+        if uri.startswith(':'):
+            uri = uri[uri.find('/'):] if '/' in uri else '/'
+
+    if not uri.startswith('/'):
+        uri = '/' + uri
+
+    sep = '&' if '?' in uri else '?'
+    return uri + sep + '__size=' + str(record.get('bytes') or 0)
+
+
+# ============================================================================
+class Replay(object):
+    def __init__(self, proxy_port, speed):
+        self.proxy_port = proxy_port
+        self.speed = speed
+
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self.latencies = []
+        self.num_errors = 0
+        self.num_tls_tunnels = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def run(self, conns):
+        self.t0 = conns[0][0]['time'] if conns else 0
+        self.start = time.time()
+
+        jobs = [gevent.spawn(self.replay_conn, requests) for requests in conns]
+        gevent.joinall(jobs)
+
+        return time.time() - self.start
+
+    def wait_until(self, record):
+        if not self.speed:
+            return
+
+        delay = (record['time'] - self.t0) / self.speed - (time.time() - self.start)
+        if delay > 0:
+            gevent.sleep(delay)
+
+    def replay_conn(self, requests):
+        self.wait_until(requests[0])
+
+        first = requests[0]
+        port = get_port(first)
+
+        if first.get('tunnel') is not None and first.get('scheme') == 'https':
+            conn = HTTPSConnection('localhost', self.proxy_port, context=self.ssl_context)
+            conn.set_tunnel(first['host'], port)
+            absolute = False
+            self.num_tls_tunnels += 1
+        else:
+            conn = HTTPConnection('localhost', self.proxy_port)
+            absolute = first.get('tunnel') is None
+            if not absolute:
+                conn.set_tunnel(first['host'], port)
+
+        try:
+            for record in requests:
+                self.wait_until(record)
+                self.replay_request(conn, record, absolute)
+
+        except Exception as e:
+            print('Replay Error: ' + str(e), file=sys.stderr)
+            self.num_errors += 1
+
+        finally:
+            conn.close()
+
+    def replay_request(self, conn, record, absolute):
+        path = get_path(record)
+        if absolute:
+            host = record['host']
+            port = get_port(record)
+            if port != 80:
+                host += ':' + str(port)
+
+            path = 'http://' + host + path
+
+        body = b'x' * (record.get('req_bytes') or 0)
+        method = record.get('method') or 'GET'
+
+        start = time.time()
+
+        conn.request(method, path, body=body or None,
+                     headers={'Connection': 'keep-alive'})
+
+        resp = conn.getresponse()
+        data = resp.read()
+
+        self.latencies.append(time.time() - start)
+        self.bytes_sent += len(body)
+        self.bytes_received += len(data)
+
+
+# ============================================================================
+def percentile(values, pct):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    pos = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[pos]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a wsgiprox access log trace')
+    parser.add_argument('trace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier, 0 to send as fast as possible')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='max number of trace records to replay')
+
+    args = parser.parse_args()
+
+    conns = load_trace(args.trace, args.limit)
+
+    ca_dir = tempfile.mkdtemp()
+
+    app = WSGIProxMiddleware(stand_in_app, '/',
+                             proxy_options={'ca_file_cache': os.path.join(ca_dir, 'ca.pem')})
+
+    server = WSGIServer(('localhost', 0), app, log=None)
+    server.init_socket()
+    gevent.spawn(server.serve_forever)
+
+    try:
+        replay = Replay(server.address[1], args.speed)
+        elapsed = replay.run(conns)
+
+    finally:
+        server.stop()
+        shutil.rmtree(ca_dir)
+
+    num = len(replay.latencies)
+
+    print('connections: {0}, requests: {1}, errors: {2}'.format(len(conns), num, replay.num_errors))
+    print('elapsed: {0:.2f}s, {1:.1f} req/s, {2:.2f} MB/s'.format(
+          elapsed, num / elapsed if elapsed else 0,
+          (replay.bytes_sent + replay.bytes_received) / elapsed / 1e6 if elapsed else 0))
+
+    print('latency ms: p50 {0:.2f}, p90 {1:.2f}, p99 {2:.2f}, max {3:.2f}'.format(
+          *[percentile(replay.latencies, pct) * 1000 for pct in (50, 90, 99, 100)]))
+
+    print('tunnels: {0}, of which tls: {1}'.format(app.num_tunnels, replay.num_tls_tunnels))
+
+
+if __name__ == '__main__':
+    main()
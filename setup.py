@@ -38,7 +38,9 @@ setup(
     data_files=[
     ],
     extras_require={
-        'gevent-websocket':  ['gevent-websocket'],
+        # no longer needed, websockets are built in
+        'gevent-websocket':  [],
+        'numpy':  ['numpy'],
     },
     entry_points="""
         [console_scripts]
@@ -0,0 +1,41 @@
+""" Runs the fixture app in a threaded server without gevent, with real
+threads and blocking sockets, as the test module is monkeypatched.
+Prints the port once listening.
+
+* ``FILL_FDS``: open this many files first, so that sockets get fds
+  past FD_SETSIZE
+* ``HEADER_TIMEOUT``: the tunnel ``header_timeout``
+"""
+from fixture_app import make_application
+from wsgiprox.threaded import make_threaded_server
+
+import os
+import sys
+
+
+# ============================================================================
+def main():
+    num_fds = int(os.environ.get('FILL_FDS', 0))
+    fds = [os.open(os.devnull, os.O_RDONLY) for _ in range(num_fds)]
+
+    proxy_options = {}
+
+    if os.environ.get('HEADER_TIMEOUT'):
+        proxy_options['header_timeout'] = float(os.environ['HEADER_TIMEOUT'])
+
+    # also wait on blocked writes
+    if num_fds:
+        proxy_options['write_timeout'] = 30
+
+    app = make_application(proxy_options=proxy_options)
+
+    server = make_threaded_server(app, port=0, max_threads=20, quiet=True)
+
+    sys.stdout.write('port {0}\n'.format(server.server_address[1]))
+    sys.stdout.flush()
+
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
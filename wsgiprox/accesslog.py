@@ -0,0 +1,238 @@
+from __future__ import absolute_import
+
+from collections import deque
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__file__)
+
+
+# ============================================================================
+class AccessLog(object):
+    """ Structured access log, one json object per line.
+
+    Records are added to a bounded in-memory ring without locking, and
+    written in batches by a background thread, so logging never waits on
+    disk in the request path. If the writer falls behind and the ring is
+    full, new records are dropped and counted in ``num_dropped``.
+
+    When the log file reaches ``max_size``, it is rotated to ``path.1``
+    (and ``path.1`` to ``path.2``, etc), keeping ``backup_count`` old files.
+    """
+    def __init__(self, path, max_size=64 * 1024 * 1024, backup_count=5,
+                 capacity=8192, batch_size=256, flush_interval=1.0):
+
+        self.path = path
+        self.max_size = max_size
+        self.backup_count = backup_count
+
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # appends and pops are atomic, no lock needed
+        self.ring = deque()
+
+        self.num_logged = 0
+        self.num_written = 0
+        self.num_dropped = 0
+        self.num_rotated = 0
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.fh = open(path, 'ab')
+        self.size = self.fh.tell()
+
+        self.work = threading.Event()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_stats(self):
+        return {'logged': self.num_logged,
+                'written': self.num_written,
+                'dropped': self.num_dropped,
+                'pending': len(self.ring),
+                'rotated': self.num_rotated}
+
+    def log(self, record):
+        if len(self.ring) >= self.capacity or self.closed:
+            self.num_dropped += 1
+            return
+
+        self.ring.append(record)
+        self.num_logged += 1
+
+        if len(self.ring) >= self.batch_size:
+            self.work.set()
+
+    def run(self):
+        while not self.closed:
+            self.work.wait(self.flush_interval)
+            self.work.clear()
+
+            try:
+                self.write_pending()
+            except Exception as e:
+                logger.debug('Access Log Write Failed: ' + str(e))
+
+    def write_pending(self):
+        while self.ring:
+            lines = []
+
+            try:
+                for _ in range(self.batch_size):
+                    lines.append(json.dumps(self.ring.popleft(),
+                                            separators=(',', ':')))
+            except IndexError:
+                pass
+
+            lines.append('')
+
+            data = '\n'.join(lines).encode('utf-8')
+
+            self.fh.write(data)
+            self.size += len(data)
+            self.num_written += len(lines) - 1
+
+            if self.size >= self.max_size:
+                self.rotate()
+
+        self.fh.flush()
+
+    def rotate(self):
+        self.fh.close()
+
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src = '{0}.{1}'.format(self.path, i)
+                if os.path.exists(src):
+                    os.rename(src, '{0}.{1}'.format(self.path, i + 1))
+
+            os.rename(self.path, self.path + '.1')
+
+        self.fh = open(self.path, 'wb')
+        self.size = 0
+        self.num_rotated += 1
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.work.set()
+        self.thread.join()
+
+        # anything logged after the writer's last pass
+        self.write_pending()
+        self.fh.close()
+
+
+# ============================================================================
+class TimedWriter(object):
+    """ Writer wrapper, counting bytes written and time spent writing
+    """
+    __slots__ = ('writer', 'bytes', 'elapsed')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def write(self, buff):
+        start = time.time()
+        res = self.writer.write(buff)
+        self.elapsed += time.time() - start
+        self.bytes += len(buff)
+        return res
+
+
+# ============================================================================
+class LoggedResponse(object):
+    """ Response iterator wrapper for the plain http proxy path, logging
+    the request once the server has sent the response. Time spent by
+    the server between chunks is counted as write time.
+    """
+    def __init__(self, result, record, start, access_log):
+        self.result = result
+        self.record = record
+        self.start = start
+        self.access_log = access_log
+
+        self.bytes = 0
+        self.write_time = 0.0
+        self.logged = False
+
+    def __iter__(self):
+        for data in self.result:
+            self.bytes += len(data)
+
+            yielded = time.time()
+            yield data
+            self.write_time += time.time() - yielded
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+
+        finally:
+            if not self.logged:
+                self.logged = True
+
+                finish_record(self.record, self.start, self.bytes, self.write_time)
+                self.access_log.log(self.record)
+
+
+# ============================================================================
+def make_record(env, start, host=None, tunnel=None, index=None):
+    return {'time': round(start, 3),
+            'client': env.get('REMOTE_ADDR'),
+            'method': env.get('REQUEST_METHOD'),
+            'uri': env.get('REQUEST_URI'),
+            'host': host or env.get('wsgiprox.connect_host'),
+            'scheme': env.get('wsgi.url_scheme'),
+            'status': None,
+            'req_bytes': get_content_length(env),
+            'bytes': 0,
+            'handshake_ms': None,
+            'app_ms': None,
+            'write_ms': None,
+            'tunnel': tunnel,
+            'index': index}
+
+
+def finish_record(record, start, num_bytes, write_time):
+    elapsed = time.time() - start
+
+    record['bytes'] = num_bytes
+    record['app_ms'] = round((elapsed - write_time) * 1000, 3)
+    record['write_ms'] = round(write_time * 1000, 3)
+    return record
+
+
+def get_content_length(env):
+    # size not known up front
+    if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+        return None
+
+    try:
+        return int(env.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return None
+
+
+def get_status_code(statusline):
+    try:
+        return int(statusline.split(' ', 1)[0])
+    except (ValueError, AttributeError):
+        return None
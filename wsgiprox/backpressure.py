@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+
+from collections import deque
+
+import socket
+import sys
+import threading
+import time
+
+from wsgiprox.sockutil import wait_socket
+
+
+# ============================================================================
+class Backpressure(object):
+    """ Send timeouts, spooling and write metrics for responses in
+    intercepted tunnels, shared by all tunnels.
+
+    * ``write_timeout``: max seconds a write may wait for the client
+      to accept more data
+    * ``response_timeout``: max seconds to send a whole response, from
+      ``start_response()``
+    * ``spool_size``: if set, the app output is read into a buffer of up
+      to this many bytes, by a separate thread (or greenlet) from the one
+      sending it, so that a fast app is done, and its response closed,
+      while a slow client is still receiving it. Thread-locals set while
+      calling the app are not available to its response iterator, and
+      responses from apps which used ``write()`` are not spooled
+
+    A write which times out raises ``socket.timeout``, and the tunnel is
+    closed.
+    """
+    def __init__(self, write_timeout=None, response_timeout=None, spool_size=0):
+        self.write_timeout = write_timeout
+        self.response_timeout = response_timeout
+        self.spool_size = spool_size
+
+        self.lock = threading.Lock()
+
+        self.num_writes = 0
+        self.bytes_written = 0
+        self.blocked_time = 0.0
+        self.max_blocked = 0.0
+        self.num_timeouts = 0
+        self.num_spooled = 0
+
+    def get_writer(self, sock):
+        return DeadlineWriter(sock, self)
+
+    def spool(self, result):
+        with self.lock:
+            self.num_spooled += 1
+
+        return SpooledResponse(result, self.spool_size)
+
+    def add_write(self, size, elapsed):
+        with self.lock:
+            self.num_writes += 1
+            self.bytes_written += size
+            self.blocked_time += elapsed
+            if elapsed > self.max_blocked:
+                self.max_blocked = elapsed
+
+    def add_timeout(self):
+        with self.lock:
+            self.num_timeouts += 1
+
+    def get_stats(self):
+        return {'writes': self.num_writes,
+                'bytes_written': self.bytes_written,
+                'blocked_time': self.blocked_time,
+                'max_blocked': self.max_blocked,
+                'timeouts': self.num_timeouts,
+                'spooled': self.num_spooled}
+
+
+# ============================================================================
+class DeadlineWriter(object):
+    """ Tunnel socket writer, timing each write, with a timeout per write
+    and a deadline for the current response, if set
+    """
+    __slots__ = ('socket', 'raw_sock', 'backpressure', 'deadline')
+
+    def __init__(self, sock, backpressure):
+        self.socket = sock
+
+        # the tcp socket, for tls connections
+        self.raw_sock = sock.get_socket() if hasattr(sock, 'get_socket') else sock
+
+        self.backpressure = backpressure
+        self.deadline = None
+
+    def reset_deadline(self):
+        if self.backpressure.response_timeout:
+            self.deadline = time.time() + self.backpressure.response_timeout
+        else:
+            self.deadline = None
+
+    def write(self, buff):
+        timeout = self.backpressure.write_timeout
+
+        if self.deadline is not None:
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                self.backpressure.add_timeout()
+                raise socket.timeout('response send timed out')
+
+            if not timeout or remaining < timeout:
+                timeout = remaining
+
+        start = time.time()
+
+        try:
+            if timeout:
+                self.sendall(buff, timeout)
+            else:
+                self.socket.sendall(buff)
+
+        except socket.timeout:
+            self.backpressure.add_timeout()
+            raise
+
+        finally:
+            self.backpressure.add_write(len(buff), time.time() - start)
+
+    def sendall(self, buff, timeout):
+        orig_timeout = self.raw_sock.gettimeout()
+        self.raw_sock.settimeout(timeout)
+
+        view = memoryview(buff)
+
+        try:
+            while len(view):
+                try:
+                    sent = self.socket.send(view)
+
+                except Exception as e:
+                    # only with pyOpenSSL, not patched by gevent
+                    SSL = sys.modules.get('OpenSSL.SSL')
+                    if not SSL or not isinstance(e, (SSL.WantWriteError, SSL.WantReadError)):
+                        raise
+
+                    if not wait_socket(self.raw_sock, write=True, timeout=timeout):
+                        raise socket.timeout('write timed out')
+
+                    continue
+
+                view = view[sent:]
+
+        finally:
+            view.release()
+            self.raw_sock.settimeout(orig_timeout)
+
+
+# ============================================================================
+class SpooledResponse(object):
+    """ Response iterator, read from the app response by a separate
+    thread into a buffer of up to ``max_size`` bytes. The app response
+    is closed by that thread once fully read, or once this is closed
+    """
+    def __init__(self, result, max_size):
+        self.result = result
+        self.max_size = max_size
+
+        self.chunks = deque()
+        self.size = 0
+
+        self.done = False
+        self.closed = False
+        self.error = None
+
+        self.cond = threading.Condition()
+
+        thread = threading.Thread(target=self.fill)
+        thread.daemon = True
+        thread.start()
+
+    def fill(self):
+        try:
+            for data in self.result:
+                if not data:
+                    continue
+
+                with self.cond:
+                    while self.size >= self.max_size and not self.closed:
+                        self.cond.wait()
+
+                    if self.closed:
+                        break
+
+                    self.chunks.append(data)
+                    self.size += len(data)
+                    self.cond.notify_all()
+
+        except Exception as e:
+            self.error = e
+
+        finally:
+            try:
+                if hasattr(self.result, 'close'):
+                    self.result.close()
+
+            finally:
+                with self.cond:
+                    self.done = True
+                    self.cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self.cond:
+                while not self.chunks and not self.done:
+                    self.cond.wait()
+
+                if self.chunks:
+                    data = self.chunks.popleft()
+                    self.size -= len(data)
+                    self.cond.notify_all()
+
+                elif self.error:
+                    raise self.error
+
+                else:
+                    return
+
+            yield data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.chunks.clear()
+            self.size = 0
+            self.cond.notify_all()
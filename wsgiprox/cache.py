@@ -0,0 +1,688 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import six
+
+from wsgiprox.resolvers import LRUCache
+
+
+logger = logging.getLogger(__file__)
+
+
+# ============================================================================
+def parse_cache_control(value):
+    directives = {}
+    if not value:
+        return directives
+
+    for part in value.lower().split(','):
+        name, _, arg = part.partition('=')
+        name = name.strip()
+        if name:
+            directives[name] = arg.strip().strip('"')
+
+    return directives
+
+
+def parse_http_date(value):
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except Exception:
+        return None
+
+
+def to_native(value):
+    if six.PY2 and isinstance(value, six.text_type):  #pragma: no cover
+        return value.encode('iso-8859-1')
+
+    return value
+
+
+# ============================================================================
+class CacheEntry(object):
+    __slots__ = ('key', 'uri', 'status', 'headers', 'body', 'vary',
+                 'stored_at', 'freshness', 'initial_age',
+                 'etag', 'last_modified')
+
+    def __init__(self, key, uri, status, headers, body, vary=(),
+                 stored_at=None, freshness=0, initial_age=0):
+        self.key = key
+        self.uri = uri
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.vary = tuple(vary)
+
+        self.stored_at = stored_at or time.time()
+        self.freshness = freshness
+        self.initial_age = initial_age
+
+        self.etag = None
+        self.last_modified = None
+
+        for name, value in headers:
+            name = name.lower()
+            if name == 'etag':
+                self.etag = value
+            elif name == 'last-modified':
+                self.last_modified = value
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(n) + len(v) for n, v in self.headers)
+
+    def get_age(self, now):
+        return self.initial_age + max(0, now - self.stored_at)
+
+    def is_fresh(self, now):
+        return self.get_age(now) < self.freshness
+
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+    def to_meta(self):
+        return {'key': self.key,
+                'uri': self.uri,
+                'status': self.status,
+                'headers': self.headers,
+                'vary': self.vary,
+                'stored_at': self.stored_at,
+                'freshness': self.freshness,
+                'initial_age': self.initial_age}
+
+    @classmethod
+    def from_meta(cls, meta, body):
+        headers = [(to_native(n), to_native(v)) for n, v in meta['headers']]
+        return cls(to_native(meta['key']),
+                   to_native(meta['uri']),
+                   to_native(meta['status']),
+                   headers,
+                   body,
+                   [to_native(v) for v in meta['vary']],
+                   meta['stored_at'],
+                   meta['freshness'],
+                   meta['initial_age'])
+
+
+# ============================================================================
+class MemoryTier(object):
+    """ Size-bounded (in bytes) LRU of cache entries. Entries evicted
+    to make room are passed to ``on_evict``, eg. to move them to disk.
+    """
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+
+        self.entries = OrderedDict()
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.entries[key] = entry
+
+            return entry
+
+    def put(self, entry):
+        evicted = []
+
+        with self.lock:
+            old = self.entries.pop(entry.key, None)
+            if old:
+                self.total_size -= old.size
+
+            self.entries[entry.key] = entry
+            self.total_size += entry.size
+
+            while self.total_size > self.max_size and self.entries:
+                _, old = self.entries.popitem(last=False)
+                self.total_size -= old.size
+                evicted.append(old)
+
+        if self.on_evict:
+            for old in evicted:
+                self.on_evict(old)
+
+    def remove(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.total_size -= old.size
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# ============================================================================
+class DiskTier(object):
+    """ Size-bounded store of cache entries, one file per entry, in
+    ``cache_dir``. Writes and eviction of least recently used files are
+    done by a background thread, entries waiting to be written are
+    still served from memory.
+    """
+    LOW_WATER = 0.9
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        # filename -> size, least recently used first
+        self.index = OrderedDict()
+        self.total_size = 0
+
+        # key -> entry, not yet written
+        self.pending = OrderedDict()
+
+        self.lock = threading.Lock()
+        self.work = threading.Event()
+        self.closed = False
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.load_index()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load_index(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.entry'):
+                continue
+
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            files.append((stat.st_mtime, name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self.index[name] = size
+            self.total_size += size
+
+        if self.total_size > self.max_size:
+            self.work.set()
+
+    @staticmethod
+    def get_filename(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.entry'
+
+    def get(self, key):
+        filename = self.get_filename(key)
+
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry:
+                return entry
+
+            size = self.index.pop(filename, None)
+            if size is None:
+                return None
+
+            self.index[filename] = size
+
+        try:
+            with open(os.path.join(self.cache_dir, filename), 'rb') as fh:
+                meta = json.loads(fh.readline().decode('utf-8'))
+                body = fh.read()
+
+            if meta['key'] != key:
+                return None
+
+            return CacheEntry.from_meta(meta, body)
+
+        except Exception as e:
+            logger.debug('Invalid Cache Entry: ' + str(e))
+            self.remove(key)
+            return None
+
+    def put(self, entry):
+        with self.lock:
+            self.pending[entry.key] = entry
+
+        self.work.set()
+
+    def remove(self, key):
+        filename = self.get_filename(key)
+
+        with self.lock:
+            self.pending.pop(key, None)
+            size = self.index.pop(filename, None)
+            if size is None:
+                return
+
+            self.total_size -= size
+
+        self._unlink(filename)
+
+    def run(self):
+        while not self.closed:
+            self.work.wait()
+            self.work.clear()
+
+            while True:
+                with self.lock:
+                    if not self.pending:
+                        break
+
+                    entry = self.pending[next(iter(self.pending))]
+
+                try:
+                    self.write(entry)
+                except Exception as e:
+                    logger.debug('Cache Write Failed: ' + str(e))
+
+                with self.lock:
+                    # not replaced or removed while writing
+                    if self.pending.get(entry.key) is entry:
+                        del self.pending[entry.key]
+
+            self.evict()
+
+    def write(self, entry):
+        filename = self.get_filename(entry.key)
+        path = os.path.join(self.cache_dir, filename)
+        tmp_path = path + '.tmp'
+
+        meta = json.dumps(entry.to_meta()).encode('utf-8')
+
+        with open(tmp_path, 'wb') as fh:
+            fh.write(meta + b'\n')
+            fh.write(entry.body)
+
+        os.rename(tmp_path, path)
+
+        size = len(meta) + 1 + len(entry.body)
+
+        with self.lock:
+            self.total_size -= self.index.pop(filename, 0)
+            self.index[filename] = size
+            self.total_size += size
+
+    def evict(self):
+        if self.total_size <= self.max_size:
+            return
+
+        target = self.max_size * self.LOW_WATER
+
+        while True:
+            with self.lock:
+                if self.total_size <= target or not self.index:
+                    return
+
+                filename, size = self.index.popitem(last=False)
+                self.total_size -= size
+
+            self._unlink(filename)
+
+    def _unlink(self, filename):
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except OSError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.work.set()
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+
+# ============================================================================
+class ResponseCache(object):
+    """ Cache of responses from the wrapped app, keyed on the resolved
+    ``REQUEST_URI`` and the request headers named in the response's
+    ``Vary``.
+
+    Only ``GET`` responses with a cacheable status, and either a freshness
+    lifetime (``Cache-Control: max-age``, ``Expires``, or a heuristic from
+    ``Last-Modified``) or validators (``ETag``, ``Last-Modified``) are
+    stored. Fresh entries are served directly, stale entries are
+    revalidated with a conditional request to the app.
+
+    Entries are kept in a memory LRU of ``max_memory`` bytes. If
+    ``cache_dir`` is set, entries evicted from memory are moved to disk,
+    up to ``max_disk`` bytes.
+    """
+    CACHEABLE_STATUSES = ('200', '203', '300', '301', '404', '410')
+
+    # not stored or replayed from the cache
+    HOP_BY_HOP = ('connection', 'keep-alive', 'transfer-encoding',
+                  'content-length', 'age', 'proxy-connection', 'te',
+                  'trailer', 'upgrade')
+
+    # max freshness lifetime, when computed from Last-Modified
+    MAX_HEURISTIC = 86400
+
+    def __init__(self, max_memory=64 * 1024 * 1024,
+                 cache_dir=None, max_disk=1024 * 1024 * 1024,
+                 max_entry_size=8 * 1024 * 1024,
+                 max_uris=100000):
+
+        self.max_entry_size = max_entry_size
+
+        self.disk = None
+        if cache_dir:
+            self.disk = DiskTier(cache_dir, max_disk)
+
+        self.memory = MemoryTier(max_memory,
+                                 self.disk.put if self.disk is not None else None)
+
+        # uri -> header names from the response's Vary
+        self.vary_index = LRUCache(max_uris)
+
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stores = 0
+        self.bytes_saved = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.revalidated + self.misses
+        if not total:
+            return 0.0
+
+        return float(self.hits + self.revalidated) / total
+
+    def get_stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'stores': self.stores,
+                'hit_ratio': self.hit_ratio,
+                'bytes_saved': self.bytes_saved,
+                'memory_entries': len(self.memory),
+                'memory_size': self.memory.total_size,
+                'disk_entries': len(self.disk) if self.disk is not None else 0,
+                'disk_size': self.disk.total_size if self.disk is not None else 0}
+
+    def _count(self, name, saved=0):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+            self.bytes_saved += saved
+
+    def __call__(self, env, start_response, app):
+        method = env.get('REQUEST_METHOD')
+        uri = env['REQUEST_URI']
+
+        if method != 'GET':
+            if method not in ('HEAD', 'OPTIONS', 'TRACE'):
+                # unsafe method, invalidate stored responses
+                self.vary_index.delete(uri)
+
+            return app(env, start_response)
+
+        req_cc = parse_cache_control(env.get('HTTP_CACHE_CONTROL'))
+
+        # websocket upgrades must always reach the app
+        if ('no-store' in req_cc or 'HTTP_AUTHORIZATION' in env or
+            'HTTP_RANGE' in env or 'HTTP_UPGRADE' in env):
+            return app(env, start_response)
+
+        no_cache = 'no-cache' in req_cc or 'no-cache' in env.get('HTTP_PRAGMA', '')
+
+        entry = self.lookup(uri, env)
+        now = time.time()
+
+        if entry and not no_cache and entry.is_fresh(now):
+            self._count('hits', len(entry.body))
+            return self.serve(entry, env, start_response, now)
+
+        recorder = ResponseRecorder(self, uri, env, start_response)
+
+        # client's own conditional request, can't be answered from a stale entry
+        if (entry and entry.has_validators() and
+            'HTTP_IF_NONE_MATCH' not in env and
+            'HTTP_IF_MODIFIED_SINCE' not in env):
+            return self.revalidate(entry, env, app, recorder)
+
+        self._count('misses')
+        return recorder(app(env, recorder.start_response))
+
+    def revalidate(self, entry, env, app, recorder):
+        not_modified = []
+
+        def revalidate_sr(status, headers, exc_info=None):
+            if status.startswith('304'):
+                not_modified.append(headers)
+                return lambda data: None
+
+            return recorder.start_response(status, headers, exc_info)
+
+        if entry.etag:
+            env['HTTP_IF_NONE_MATCH'] = entry.etag
+
+        if entry.last_modified:
+            env['HTTP_IF_MODIFIED_SINCE'] = entry.last_modified
+
+        result = app(env, revalidate_sr)
+
+        if not not_modified:
+            self._count('misses')
+            return recorder(result)
+
+        if hasattr(result, 'close'):
+            result.close()
+
+        env.pop('HTTP_IF_NONE_MATCH', None)
+        env.pop('HTTP_IF_MODIFIED_SINCE', None)
+
+        entry = self.update_entry(entry, not_modified[0])
+
+        self._count('revalidated', len(entry.body))
+        return self.serve(entry, env, recorder.orig_start_response, time.time())
+
+    def update_entry(self, entry, headers):
+        """ Merge headers from a 304 into the stored entry
+        """
+        new_names = set(name.lower() for name, _ in headers)
+
+        merged = [(n, v) for n, v in entry.headers if n.lower() not in new_names]
+        merged += [(n, v) for n, v in headers if n.lower() not in self.HOP_BY_HOP]
+
+        cc = self.get_cache_control(merged)
+        freshness = self.get_freshness(entry.status, merged, cc, time.time())
+
+        entry = CacheEntry(entry.key, entry.uri, entry.status, merged,
+                           entry.body, entry.vary, freshness=freshness)
+
+        self.memory.put(entry)
+        return entry
+
+    def serve(self, entry, env, start_response, now):
+        headers = list(entry.headers)
+        headers.append(('Age', str(int(entry.get_age(now)))))
+
+        if_none_match = env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and entry.etag and (if_none_match == '*' or
+                                             entry.etag in if_none_match):
+            start_response('304 Not Modified', headers)
+            return []
+
+        headers.append(('Content-Length', str(len(entry.body))))
+        start_response(entry.status, headers)
+        return [entry.body]
+
+    def get_key(self, uri, vary, env):
+        if not vary:
+            return uri
+
+        values = [env.get('HTTP_' + name.upper().replace('-', '_'), '')
+                  for name in vary]
+
+        return uri + '\n' + '\n'.join(values)
+
+    def lookup(self, uri, env):
+        vary = self.vary_index.get(uri)
+        if vary is None:
+            return None
+
+        key = self.get_key(uri, vary, env)
+
+        entry = self.memory.get(key)
+        if entry:
+            return entry
+
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry:
+                # promote back to memory
+                self.disk.remove(key)
+                self.memory.put(entry)
+
+        return entry
+
+    @staticmethod
+    def get_cache_control(headers):
+        values = [v for n, v in headers if n.lower() == 'cache-control']
+        return parse_cache_control(','.join(values))
+
+    def get_freshness(self, status, headers, cc, now):
+        if 'no-cache' in cc:
+            return 0
+
+        for name in ('s-maxage', 'max-age'):
+            if name in cc:
+                try:
+                    return max(0, int(cc[name]))
+                except ValueError:
+                    return 0
+
+        values = dict((n.lower(), v) for n, v in headers)
+
+        date = parse_http_date(values.get('date', '')) or now
+
+        if 'expires' in values:
+            expires = parse_http_date(values['expires'])
+            return max(0, expires - date) if expires else 0
+
+        last_modified = parse_http_date(values.get('last-modified', ''))
+        if last_modified:
+            return min(self.MAX_HEURISTIC, max(0, (date - last_modified) / 10))
+
+        return 0
+
+    def store(self, uri, env, status, headers, body):
+        if not status[:3] in self.CACHEABLE_STATUSES:
+            return
+
+        cc = self.get_cache_control(headers)
+        if 'no-store' in cc or 'private' in cc:
+            return
+
+        vary = []
+        stored_headers = []
+        initial_age = 0
+
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'set-cookie':
+                return
+
+            elif lower == 'vary':
+                vary += [v.strip().lower() for v in value.split(',') if v.strip()]
+
+            elif lower == 'age':
+                try:
+                    initial_age = int(value)
+                except ValueError:
+                    pass
+
+            if lower not in self.HOP_BY_HOP:
+                stored_headers.append((name, value))
+
+        if '*' in vary:
+            return
+
+        freshness = self.get_freshness(status, headers, cc, time.time())
+
+        entry = CacheEntry(self.get_key(uri, vary, env), uri, status,
+                           stored_headers, body, vary,
+                           freshness=freshness, initial_age=initial_age)
+
+        if not freshness and not entry.has_validators():
+            return
+
+        self.vary_index.set(uri, tuple(vary))
+        self.memory.put(entry)
+        self._count('stores')
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+
+
+# ============================================================================
+class ResponseRecorder(object):
+    """ Pass a response from the app through to the client, storing
+    it once fully sent, if complete and not too large.
+    """
+    def __init__(self, cache, uri, env, start_response):
+        self.cache = cache
+        self.uri = uri
+        self.env = env
+        self.orig_start_response = start_response
+
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.size = 0
+        self.ok = True
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = headers
+        if exc_info:
+            self.ok = False
+
+        write = self.orig_start_response(status, headers, exc_info)
+
+        def record_write(data):
+            self.record(data)
+            return write(data)
+
+        return record_write
+
+    def record(self, data):
+        if not self.ok:
+            return
+
+        self.size += len(data)
+        if self.size > self.cache.max_entry_size:
+            self.ok = False
+            self.chunks = []
+            return
+
+        self.chunks.append(data)
+
+    def __call__(self, result):
+        finished = False
+
+        try:
+            for data in result:
+                self.record(data)
+                yield data
+
+            finished = True
+
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        if finished and self.ok and self.status:
+            self.cache.store(self.uri, self.env, self.status, self.headers,
+                             b''.join(self.chunks))
@@ -0,0 +1,542 @@
+from __future__ import absolute_import
+
+from six.moves import queue
+from tempfile import SpooledTemporaryFile
+
+import datetime
+import itertools
+import logging
+import os
+import threading
+import uuid
+import zlib
+
+
+logger = logging.getLogger(__file__)
+
+
+# ============================================================================
+def warc_date():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def new_record_id():
+    return '<urn:uuid:{0}>'.format(uuid.uuid4())
+
+
+def get_request_head(env, target):
+    """ Request line and headers, rebuilt from a server parsed environ
+    """
+    head = [env['REQUEST_METHOD'] + ' ' + target + ' ' +
+            env.get('SERVER_PROTOCOL', 'HTTP/1.0')]
+
+    for key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        if env.get(key):
+            head.append(key.replace('_', '-').title() + ': ' + env[key])
+
+    for key, value in env.items():
+        if key.startswith('HTTP_'):
+            head.append(key[5:].replace('_', '-').title() + ': ' + value)
+
+    head.append('\r\n')
+    return '\r\n'.join(head).encode('iso-8859-1')
+
+
+def get_response_head(protocol, statusline, headers):
+    head = [protocol + ' ' + statusline]
+
+    for name, value in headers:
+        head.append(name + ': ' + value)
+
+    head.append('\r\n')
+    return '\r\n'.join(head).encode('iso-8859-1')
+
+
+# ============================================================================
+class PendingCapture(object):
+    """ Request and response blocks of one capture, spooled by the writer
+    thread until the response is complete and the lengths are known
+    """
+    __slots__ = ('target_uri', 'date', 'request', 'response')
+
+    def __init__(self, target_uri, date, spool_size):
+        self.target_uri = target_uri
+        self.date = date
+        self.request = SpooledTemporaryFile(spool_size)
+        self.response = SpooledTemporaryFile(spool_size)
+
+    def close(self):
+        self.request.close()
+        self.response.close()
+
+
+# ============================================================================
+class CaptureWriter(object):
+    """ Writes captured request/response pairs as WARC ``request`` and
+    ``response`` records, in files of up to ``max_size`` bytes in
+    ``directory``, gzipped per record if ``gzip`` is set.
+
+    Captured data is handed to a background thread in blocks through a
+    bounded queue. If the queue is full, the capture is dropped (and
+    counted in ``num_dropped``) rather than slowing down the request.
+    """
+    BEGIN = 0
+    REQUEST = 1
+    RESPONSE = 2
+    END = 3
+
+    SPOOL_SIZE = 1024 * 1024
+
+    def __init__(self, directory, prefix='wsgiprox', max_size=1024 * 1024 * 1024,
+                 gzip=True, queue_size=256, block_size=65536):
+
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.gzip = gzip
+        self.block_size = block_size
+
+        self.queue = queue.Queue(queue_size)
+
+        self.ids = itertools.count(1)
+
+        # capture id -> PendingCapture, only used by the writer thread
+        self.pending = {}
+
+        # captures dropped after they were started
+        self.aborted = set()
+        self.lock = threading.Lock()
+
+        self.num_captured = 0
+        self.num_dropped = 0
+        self.num_files = 0
+        self.bytes_written = 0
+
+        self.fh = None
+        self.filename = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_stats(self):
+        return {'captured': self.num_captured,
+                'dropped': self.num_dropped,
+                'files': self.num_files,
+                'bytes_written': self.bytes_written,
+                'queued': self.queue.qsize()}
+
+    def start(self, target_uri):
+        """ Return a new CaptureTap for one request/response
+        """
+        return CaptureTap(self, next(self.ids), target_uri)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    def abort(self, capture_id, dropped=True):
+        with self.lock:
+            if dropped:
+                self.num_dropped += 1
+
+            self.aborted.add(capture_id)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                self.process(item)
+            except Exception as e:
+                logger.debug('Capture Write Failed: ' + str(e))
+
+        for pending in self.pending.values():
+            pending.close()
+
+        self.pending.clear()
+
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def process(self, item):
+        msg, capture_id, data = item
+
+        if self.aborted:
+            self.discard_aborted()
+
+        if msg == self.BEGIN:
+            if capture_id in self.pending or self.is_aborted(capture_id):
+                return
+
+            target_uri, date = data
+            self.pending[capture_id] = PendingCapture(target_uri, date, self.SPOOL_SIZE)
+            return
+
+        pending = self.pending.get(capture_id)
+        if not pending:
+            return
+
+        if msg == self.REQUEST:
+            pending.request.write(data)
+
+        elif msg == self.RESPONSE:
+            pending.response.write(data)
+
+        elif msg == self.END:
+            del self.pending[capture_id]
+
+            # last block, sent with the end
+            if data:
+                pending.response.write(data)
+
+            try:
+                self.write_capture(pending)
+            finally:
+                pending.close()
+
+            self.num_captured += 1
+
+    def is_aborted(self, capture_id):
+        with self.lock:
+            if capture_id in self.aborted:
+                self.aborted.discard(capture_id)
+                return True
+
+        return False
+
+    def discard_aborted(self):
+        with self.lock:
+            for capture_id in list(self.aborted):
+                pending = self.pending.pop(capture_id, None)
+                if pending:
+                    pending.close()
+                    self.aborted.discard(capture_id)
+
+    def write_capture(self, pending):
+        self.open_file()
+
+        resp_id = new_record_id()
+
+        resp_headers = [('WARC-Type', 'response'),
+                        ('WARC-Record-ID', resp_id),
+                        ('WARC-Date', pending.date),
+                        ('WARC-Target-URI', pending.target_uri),
+                        ('Content-Type', 'application/http; msgtype=response')]
+
+        req_headers = [('WARC-Type', 'request'),
+                       ('WARC-Record-ID', new_record_id()),
+                       ('WARC-Date', pending.date),
+                       ('WARC-Target-URI', pending.target_uri),
+                       ('WARC-Concurrent-To', resp_id),
+                       ('Content-Type', 'application/http; msgtype=request')]
+
+        self.write_record(resp_headers, pending.response)
+        self.write_record(req_headers, pending.request)
+
+        self.fh.flush()
+
+        if self.fh.tell() >= self.max_size:
+            self.close_file()
+
+    def open_file(self):
+        if self.fh:
+            return
+
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        ext = '.warc.gz' if self.gzip else '.warc'
+
+        self.num_files += 1
+        self.filename = '{0}-{1}-{2:05d}{3}'.format(self.prefix, timestamp,
+                                                    self.num_files, ext)
+
+        self.fh = open(os.path.join(self.directory, self.filename), 'wb')
+
+        info = ('software: wsgiprox\r\n'
+                'format: WARC File Format 1.1\r\n').encode('utf-8')
+
+        headers = [('WARC-Type', 'warcinfo'),
+                   ('WARC-Record-ID', new_record_id()),
+                   ('WARC-Date', warc_date()),
+                   ('WARC-Filename', self.filename),
+                   ('Content-Type', 'application/warc-fields')]
+
+        spool = SpooledTemporaryFile(len(info) + 1)
+        spool.write(info)
+        self.write_record(headers, spool)
+        spool.close()
+
+    def close_file(self):
+        self.fh.close()
+        self.fh = None
+
+    def write_record(self, headers, spool):
+        length = spool.tell()
+        spool.seek(0)
+
+        head = 'WARC/1.1\r\n'
+        for name, value in headers:
+            head += name + ': ' + value + '\r\n'
+
+        head += 'Content-Length: {0}\r\n\r\n'.format(length)
+
+        # gzip member per record
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.gzip else None
+
+        def write(data):
+            if compressor:
+                data = compressor.compress(data)
+
+            self.fh.write(data)
+            self.bytes_written += len(data)
+
+        write(head.encode('utf-8'))
+
+        while True:
+            buff = spool.read(self.block_size)
+            if not buff:
+                break
+
+            write(buff)
+
+        write(b'\r\n\r\n')
+
+        if compressor:
+            data = compressor.flush()
+            self.fh.write(data)
+            self.bytes_written += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+
+        # waits for already queued captures to be written
+        self.queue.put(None)
+        self.thread.join()
+
+
+# ============================================================================
+class CaptureTap(object):
+    """ Tees the request and response bytes of a single request to the
+    CaptureWriter, in blocks of up to ``block_size``
+    """
+    __slots__ = ('writer', 'capture_id', 'started', 'dropped', 'msg', 'buff', 'reader')
+
+    def __init__(self, writer, capture_id, target_uri):
+        self.writer = writer
+        self.capture_id = capture_id
+
+        self.started = writer.put((CaptureWriter.BEGIN, capture_id,
+                                   (target_uri, warc_date())))
+
+        self.dropped = not self.started
+        if self.dropped:
+            with writer.lock:
+                writer.num_dropped += 1
+
+        self.msg = CaptureWriter.REQUEST
+        self.buff = bytearray()
+
+        self.reader = None
+
+    def request(self, data):
+        if self.msg != CaptureWriter.REQUEST:
+            # request body read after the response started
+            self._flush()
+            self.msg = CaptureWriter.REQUEST
+
+        self._add(data)
+
+    def response(self, data):
+        if self.msg != CaptureWriter.RESPONSE:
+            self._flush()
+            self.msg = CaptureWriter.RESPONSE
+
+        self._add(data)
+
+    def _add(self, data):
+        if self.dropped or not data:
+            return
+
+        self.buff += data
+
+        if len(self.buff) >= self.writer.block_size:
+            self._flush()
+
+    def _flush(self):
+        if self.dropped or not self.buff:
+            return
+
+        if not self.writer.put((self.msg, self.capture_id, bytes(self.buff))):
+            self.drop()
+
+        self.buff = bytearray()
+
+    def request_head(self, env, target):
+        self.request(get_request_head(env, target))
+
+    def response_head(self, protocol, statusline, headers):
+        self.response(get_response_head(protocol, statusline, headers))
+
+    def wrap_writer(self, writer):
+        return TapWriter(writer, self)
+
+    def wrap_input(self, reader, length=None):
+        self.reader = TapReader(reader, self, length)
+        return self.reader
+
+    def wrap_response(self, result):
+        return CapturedResponse(result, self)
+
+    def drop(self):
+        """ Discard the capture, counted as dropped
+        """
+        if not self.dropped:
+            self.dropped = True
+            self.writer.abort(self.capture_id)
+
+    def cancel(self):
+        """ Discard the capture, if it should not be captured after all
+        """
+        if not self.dropped:
+            self.dropped = True
+            self.writer.abort(self.capture_id, dropped=False)
+
+    def finish(self):
+        if self.dropped:
+            return
+
+        # request body not read by the app, so the request record is complete
+        if self.reader:
+            try:
+                self.reader.drain()
+            except Exception:
+                self.drop()
+                return
+
+        self._flush()
+
+        if self.dropped:
+            return
+
+        if not self.writer.put((CaptureWriter.END, self.capture_id, bytes(self.buff))):
+            self.drop()
+
+        self.buff = bytearray()
+
+
+# ============================================================================
+class TapWriter(object):
+    """ Writer wrapper, teeing written (response) bytes to a CaptureTap
+    """
+    __slots__ = ('writer', 'tap')
+
+    def __init__(self, writer, tap):
+        self.writer = writer
+        self.tap = tap
+
+    def write(self, buff):
+        res = self.writer.write(buff)
+        self.tap.response(buff)
+        return res
+
+
+# ============================================================================
+class TapReader(object):
+    """ wsgi.input wrapper, teeing the request body, as it is read
+    by the app, to a CaptureTap. The rest of a body of a known ``length``
+    is read by drain(), once the app is done
+    """
+    def __init__(self, reader, tap, length=None):
+        self.reader = reader
+        self.tap = tap
+        self.length = length
+        self.num_read = 0
+
+    def read(self, size=-1):
+        buff = self.reader.read(size)
+        self.num_read += len(buff)
+        self.tap.request(buff)
+        return buff
+
+    def readline(self, limit=-1):
+        buff = self.reader.readline(limit)
+        self.num_read += len(buff)
+        self.tap.request(buff)
+        return buff
+
+    def readinto(self, buff):
+        res = self.reader.readinto(buff)
+        if res:
+            self.num_read += res
+            self.tap.request(bytes(memoryview(buff)[:res]))
+        return res
+
+    def drain(self, block_size=65536):
+        if self.length is None:
+            return
+
+        remaining = self.length - self.num_read
+        while remaining > 0:
+            buff = self.read(min(remaining, block_size))
+            if not buff:
+                break
+
+            remaining -= len(buff)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+
+            yield line
+
+    def close(self):
+        self.reader.close()
+
+
+# ============================================================================
+class CapturedResponse(object):
+    """ Response iterator wrapper for the plain http proxy path, teeing
+    the response body and finishing the capture when closed
+    """
+    def __init__(self, result, tap):
+        self.result = result
+        self.tap = tap
+        self.complete = False
+
+    def __iter__(self):
+        for data in self.result:
+            self.tap.response(data)
+            yield data
+
+        self.complete = True
+
+    def close(self):
+        try:
+            if hasattr(self.result, 'close'):
+                self.result.close()
+
+        finally:
+            # only complete responses are captured
+            if self.complete:
+                self.tap.finish()
+            else:
+                self.tap.drop()
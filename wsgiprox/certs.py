@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+from io import BytesIO
+
+import random
+import threading
+
+from OpenSSL import crypto
+
+from wsgiprox.resolvers import LRUCache
+
+
+# ============================================================================
+def default_extract():
+    try:
+        import tldextract
+    except ImportError:  #pragma: no cover
+        return None
+
+    # bundled public suffix list snapshot only, no network fetch
+    return tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+
+# ============================================================================
+class WildcardCertStrategy(object):
+    """ Issue one wildcard cert per registrable domain (per the public
+    suffix list), instead of per parent of each host.
+
+    For ``www.example.co.uk`` the cert is for ``example.co.uk`` and
+    ``*.example.co.uk``. Deeper hosts, eg. ``a.b.example.co.uk``, get a
+    cert for ``b.example.co.uk`` that also covers the registrable domain
+    and its direct subdomains. Every name covered by a cert is indexed,
+    so sibling hosts reuse whichever cert already covers them.
+    """
+    def __init__(self, ca, extract=None, max_names=10000, workers=None):
+        self.ca = ca
+        self.extract = extract or default_extract()
+
+        self.workers = workers
+        self._ca_pem = None
+
+        # dns name (or wildcard) -> cert cache key
+        self.covered = LRUCache(max_names)
+
+        # guards the ca cert cache and key_locks
+        self.lock = threading.Lock()
+
+        # cert cache key -> lock held while minting that cert
+        self.key_locks = {}
+
+    def load_cert(self, host):
+        if self.ca.is_host_ip(host) or not self.extract:
+            # certauth's cert cache is not thread-safe
+            with self.lock:
+                return self.ca.load_cert(host, wildcard=True,
+                                         wildcard_use_parent=True)
+
+        host = host.lower()
+
+        res = self.load_covering_cert(host)
+        if res:
+            return res
+
+        cache_key, names = self.get_cert_names(host)
+
+        cert_str = self.get_cached(cache_key)
+
+        if not cert_str:
+            # only one thread (or greenlet) mints a given cert
+            with self.get_key_lock(cache_key):
+                cert_str = self.get_cached(cache_key)
+
+                if not cert_str:
+                    cert, key = self.generate_cert(cache_key, names)
+
+                    buff = BytesIO()
+                    self.ca.write_pem(buff, cert, key)
+                    cert_str = buff.getvalue()
+
+                    self.set_cached(cache_key, cert_str)
+
+            with self.lock:
+                self.key_locks.pop(cache_key, None)
+
+        cert, key = self.ca.read_pem(BytesIO(cert_str))
+
+        # index names actually in the cert, which may have been
+        # created (and cached) with a different strategy
+        for name in self.get_cert_alt_names(cert):
+            self.covered.set(name, cache_key)
+
+        return cert, key
+
+    def get_cached(self, cache_key):
+        with self.lock:
+            return self.ca.cert_cache.get(cache_key)
+
+    def set_cached(self, cache_key, cert_str):
+        with self.lock:
+            self.ca.cert_cache[cache_key] = cert_str
+
+    def get_key_lock(self, cache_key):
+        with self.lock:
+            key_lock = self.key_locks.get(cache_key)
+            if not key_lock:
+                key_lock = self.key_locks[cache_key] = threading.Lock()
+
+            return key_lock
+
+    def load_covering_cert(self, host):
+        cache_key = self.covered.get(host)
+
+        if not cache_key and '.' in host:
+            cache_key = self.covered.get('*.' + host.split('.', 1)[1])
+
+        if not cache_key:
+            return None
+
+        cert_str = self.get_cached(cache_key)
+        if not cert_str:
+            return None
+
+        return self.ca.read_pem(BytesIO(cert_str))
+
+    def get_cert_names(self, host):
+        ext = self.extract(host)
+
+        # unknown suffix or single label
+        if not ext.suffix or not ext.domain:
+            return host, [host, '*.' + host]
+
+        registrable = ext.domain + '.' + ext.suffix
+        names = [registrable, '*.' + registrable]
+
+        # more than one label below the registrable domain, so not
+        # covered by its wildcard: also cover the parent's level
+        if '.' in ext.subdomain:
+            parent = host.split('.', 1)[1]
+            names += [parent, '*.' + parent]
+            return parent, names
+
+        return registrable, names
+
+    @staticmethod
+    def get_cert_alt_names(cert):
+        for i in range(cert.get_extension_count()):
+            ext = cert.get_extension(i)
+            if ext.get_short_name() != b'subjectAltName':
+                continue
+
+            for name in str(ext).split(','):
+                name = name.strip()
+                if name.startswith('DNS:'):
+                    yield name[4:]
+
+    def generate_cert(self, common_name, names):
+        if not self.workers:
+            return generate_cert(self.ca.ca_cert, self.ca.ca_key,
+                                 common_name, names,
+                                 self.ca.cert_not_before,
+                                 self.ca.cert_not_after)
+
+        if self.workers.process_pool:
+            # crypto objects can't be pickled, pass pem across instead
+            if not self._ca_pem:
+                buff = BytesIO()
+                self.ca.write_pem(buff, self.ca.ca_cert, self.ca.ca_key)
+                self._ca_pem = buff.getvalue()
+
+            cert_str = self.workers.run_in_process(generate_cert_pem,
+                                                   self._ca_pem,
+                                                   common_name, names,
+                                                   self.ca.cert_not_before,
+                                                   self.ca.cert_not_after)
+
+            return self.ca.read_pem(BytesIO(cert_str))
+
+        return self.workers.run_in_thread(generate_cert,
+                                          self.ca.ca_cert, self.ca.ca_key,
+                                          common_name, names,
+                                          self.ca.cert_not_before,
+                                          self.ca.cert_not_after)
+
+
+# ============================================================================
+def generate_cert(ca_cert, ca_key, common_name, names, not_before, not_after,
+                  hash_func='sha256'):
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+
+    cert = crypto.X509()
+    cert.set_serial_number(random.randint(0, 2 ** 64 - 1))
+    cert.get_subject().CN = common_name.encode('utf-8')
+
+    cert.set_version(2)
+    cert.gmtime_adj_notBefore(not_before)
+    cert.gmtime_adj_notAfter(not_after)
+
+    cert.set_issuer(ca_cert.get_subject())
+    cert.set_pubkey(key)
+
+    alt_names = ', '.join('DNS:' + name for name in names)
+
+    cert.add_extensions([
+        crypto.X509Extension(b'subjectAltName',
+                             False,
+                             alt_names.encode('utf-8'))])
+
+    cert.sign(ca_key, hash_func)
+    return cert, key
+
+
+def generate_cert_pem(ca_pem, common_name, names, not_before, not_after):
+    """ generate_cert() for running in a separate process: the CA is
+    passed in, and the cert and key returned, as pem
+    """
+    ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, ca_pem)
+    ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, ca_pem)
+
+    cert, key = generate_cert(ca_cert, ca_key, common_name, names,
+                              not_before, not_after)
+
+    return (crypto.dump_privatekey(crypto.FILETYPE_PEM, key) +
+            crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+
+import socket
+import time
+
+import six
+
+
+TLS_HANDSHAKE = 0x16
+TLS_CLIENT_HELLO = 0x01
+
+EXT_SERVER_NAME = 0x0000
+EXT_ALPN = 0x0010
+EXT_SUPPORTED_VERSIONS = 0x002b
+
+RECORD_HEADER_LEN = 5
+
+MAX_RECORD_LEN = 16384 + RECORD_HEADER_LEN
+
+
+# ============================================================================
+class ClientHello(object):
+    """ Result of peeking at the first bytes sent over a tunnel.
+
+    `is_tls` is set if the data starts with a TLS handshake record,
+    `is_http` if it starts with a plaintext HTTP request line.
+    `is_truncated` is set if more data is needed to read the first record.
+    `is_complete` is only set if the full ClientHello was parsed,
+    in which case `sni`, `alpn` and `versions` are authoritative.
+    """
+    def __init__(self):
+        self.is_tls = False
+        self.is_http = False
+        self.is_truncated = False
+        self.is_complete = False
+
+        self.sni = None
+        self.alpn = []
+        self.versions = []
+
+
+# ============================================================================
+def parse_client_hello(buff):
+    hello = ClientHello()
+
+    data = bytearray(buff)
+    if not data:
+        return hello
+
+    if data[0] != TLS_HANDSHAKE:
+        # a TLS record never starts with a letter, HTTP methods always do
+        hello.is_http = 0x41 <= data[0] <= 0x5a
+        return hello
+
+    hello.is_tls = True
+
+    if len(data) < RECORD_HEADER_LEN:
+        hello.is_truncated = True
+        return hello
+
+    record = bytearray()
+    pos = 0
+
+    # the ClientHello may be fragmented over several handshake records
+    while True:
+        if len(data) < pos + RECORD_HEADER_LEN:
+            hello.is_truncated = True
+            return hello
+
+        if data[pos] != TLS_HANDSHAKE:
+            return hello
+
+        record_len = _read_u16(data, pos + 3)
+        pos += RECORD_HEADER_LEN
+        fragment = data[pos:pos + record_len]
+
+        if len(fragment) < record_len:
+            hello.is_truncated = True
+            return hello
+
+        record += fragment
+        pos += record_len
+
+        # handshake type (1), length (3)
+        if len(record) >= 4 and len(record) >= 4 + _read_u24(record, 1):
+            break
+
+    try:
+        _parse_handshake(record, hello)
+    except IndexError:
+        pass
+
+    return hello
+
+
+def _parse_handshake(record, hello):
+    if record[0] != TLS_CLIENT_HELLO:
+        return
+
+    # handshake type (1), length (3), client_version (2), random (32)
+    pos = 4 + 2 + 32
+
+    # session id
+    pos += 1 + record[pos]
+
+    # cipher suites
+    pos += 2 + _read_u16(record, pos)
+
+    # compression methods
+    pos += 1 + record[pos]
+
+    if pos >= len(record):
+        # no extensions
+        hello.is_complete = True
+        return
+
+    ext_end = pos + 2 + _read_u16(record, pos)
+    pos += 2
+
+    while pos + 4 <= ext_end:
+        ext_type = _read_u16(record, pos)
+        ext_len = _read_u16(record, pos + 2)
+        pos += 4
+
+        ext = record[pos:pos + ext_len]
+        pos += ext_len
+
+        if ext_type == EXT_SERVER_NAME:
+            hello.sni = _parse_sni(ext)
+
+        elif ext_type == EXT_ALPN:
+            hello.alpn = _parse_alpn(ext)
+
+        elif ext_type == EXT_SUPPORTED_VERSIONS:
+            hello.versions = [_read_u16(ext, i) for i in range(1, 1 + ext[0], 2)]
+
+    # extensions past the end of the record were not parsed
+    hello.is_complete = ext_end <= len(record)
+
+
+def _parse_sni(ext):
+    pos = 2
+    while pos + 3 <= len(ext):
+        name_type = ext[pos]
+        name_len = _read_u16(ext, pos + 1)
+        pos += 3
+
+        # host_name
+        if name_type == 0:
+            name = bytes(ext[pos:pos + name_len])
+            if six.PY3:  #pragma: no cover
+                name = name.decode('iso-8859-1')
+            return name
+
+        pos += name_len
+
+    return None
+
+
+def _parse_alpn(ext):
+    protos = []
+    pos = 2
+    while pos < len(ext):
+        proto_len = ext[pos]
+        protos.append(bytes(ext[pos + 1:pos + 1 + proto_len]))
+        pos += 1 + proto_len
+
+    return protos
+
+
+def _read_u16(data, pos):
+    return (data[pos] << 8) | data[pos + 1]
+
+
+def _read_u24(data, pos):
+    return (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+
+
+# ============================================================================
+def peek_client_hello(sock, max_wait=2.0, retry_interval=0.005):
+    """ Peek (without consuming) the first data sent by the client
+    and parse it as either a TLS ClientHello or an HTTP request line.
+
+    If the ClientHello spans several TCP segments, keep peeking until
+    the full record is available or `max_wait` seconds have passed.
+    """
+    deadline = time.time() + max_wait
+
+    while True:
+        buff = sock.recv(MAX_RECORD_LEN, socket.MSG_PEEK)
+        hello = parse_client_hello(buff)
+
+        if not hello.is_truncated:
+            return hello
+
+        # truncated record: peek returns immediately if data is pending,
+        # so wait a bit for the rest to arrive
+        if time.time() >= deadline:
+            return hello
+
+        time.sleep(retry_interval)
@@ -0,0 +1,340 @@
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+# ============================================================================
+class CoalescedResponseError(Exception):
+    pass
+
+
+# ============================================================================
+class Flight(object):
+    """ A single in-progress app call, shared by all identical requests
+    which arrive while it is running.
+
+    Once more than ``max_size`` bytes are buffered, chunks already sent
+    to all followers are dropped.
+    """
+    __slots__ = ('status', 'headers', 'shared', 'chunks', 'base', 'size',
+                 'max_size', 'readers', 'done', 'failed', 'cond')
+
+    def __init__(self, max_size):
+        self.status = None
+        self.headers = None
+        self.shared = True
+
+        self.chunks = []
+        # index in the response of chunks[0], once earlier ones are dropped
+        self.base = 0
+        self.size = 0
+        self.max_size = max_size
+
+        self.readers = set()
+
+        self.done = False
+        self.failed = False
+        self.cond = threading.Condition()
+
+    def set_headers(self, status, headers, shared=True):
+        with self.cond:
+            self.status = status
+            self.headers = headers
+            self.shared = shared
+            self.cond.notify_all()
+
+    def join(self, timeout):
+        reader = FlightReader(self, timeout)
+
+        with self.cond:
+            self.readers.add(reader)
+
+        return reader
+
+    def leave(self, reader):
+        with self.cond:
+            self.readers.discard(reader)
+            self._trim()
+
+    def add(self, data):
+        if not data:
+            return
+
+        with self.cond:
+            self.chunks.append(data)
+            self.size += len(data)
+            self._trim()
+            self.cond.notify_all()
+
+    def _trim(self):
+        if self.size <= self.max_size:
+            return
+
+        if self.readers:
+            pos = min(reader.pos for reader in self.readers)
+        else:
+            pos = self.base + len(self.chunks)
+
+        drop = pos - self.base
+        if drop <= 0:
+            return
+
+        for data in self.chunks[:drop]:
+            self.size -= len(data)
+
+        del self.chunks[:drop]
+        self.base = pos
+
+    def finish(self, failed=False):
+        with self.cond:
+            self.done = True
+            self.failed = failed
+            self.cond.notify_all()
+
+    def wait_headers(self, timeout):
+        with self.cond:
+            if self.status is None and not self.done:
+                self.cond.wait(timeout)
+
+            return self.status is not None
+
+    def iter_chunks(self, reader, timeout):
+        try:
+            while True:
+                # paced by the leader, give up if it stalls
+                deadline = time.time() + timeout
+
+                with self.cond:
+                    while reader.pos == self.base + len(self.chunks) and not self.done:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise CoalescedResponseError('Coalesced response timed out')
+
+                        self.cond.wait(remaining)
+
+                    chunks = self.chunks[reader.pos - self.base:]
+                    done = self.done
+                    failed = self.failed
+
+                for data in chunks:
+                    yield data
+
+                with self.cond:
+                    reader.pos += len(chunks)
+                    self._trim()
+
+                # all chunks were taken once done
+                if done:
+                    if failed:
+                        raise CoalescedResponseError('Coalesced response did not complete')
+
+                    return
+
+        finally:
+            self.leave(reader)
+
+
+# ============================================================================
+class FlightReader(object):
+    """ A waiting request's response, read from the flight's chunks as
+    they are added
+    """
+    __slots__ = ('flight', 'timeout', 'pos')
+
+    def __init__(self, flight, timeout):
+        self.flight = flight
+        self.timeout = timeout
+
+        # index of the next chunk to send
+        self.pos = 0
+
+    def __iter__(self):
+        return self.flight.iter_chunks(self, self.timeout)
+
+    def close(self):
+        self.flight.leave(self)
+
+
+# ============================================================================
+class RequestCoalescer(object):
+    """ Collapse identical concurrent GET requests into a single call to
+    the app. The first request (the leader) calls the app and streams the
+    response as usual, while identical requests arriving before it
+    finishes are sent the same status, headers and body as it is produced.
+
+    Requests are identical if they have the same ``REQUEST_URI`` and
+    the same values for the ``KEY_HEADERS``. Requests with a body,
+    credentials, a range, an upgrade or ``no-cache`` are never coalesced.
+
+    Responses which are specific to a user (``Set-Cookie``, ``private``
+    or ``no-store``) or vary on headers not in the key are not shared,
+    and waiting requests call the app themselves, as they do if the
+    leader has not started its response within ``timeout`` seconds.
+    A waiting request also ends with an error if the leader's response
+    makes no progress for ``timeout`` seconds.
+
+    Once a response is larger than ``max_size``, requests arriving later
+    call the app themselves, and only the part not yet sent to every
+    waiting request is kept.
+    """
+    KEY_HEADERS = ('HTTP_ACCEPT',
+                   'HTTP_ACCEPT_ENCODING',
+                   'HTTP_ACCEPT_LANGUAGE',
+                   'HTTP_COOKIE',
+                   'HTTP_IF_NONE_MATCH',
+                   'HTTP_IF_MODIFIED_SINCE')
+
+    SKIP_HEADERS = ('HTTP_AUTHORIZATION',
+                    'HTTP_RANGE',
+                    'HTTP_UPGRADE')
+
+    def __init__(self, timeout=10, max_size=4 * 1024 * 1024):
+        self.timeout = timeout
+        self.max_size = max_size
+
+        self.flights = {}
+        self.lock = threading.Lock()
+
+        self.num_calls = 0
+        self.num_coalesced = 0
+        self.num_fallbacks = 0
+
+    def get_stats(self):
+        return {'calls': self.num_calls,
+                'coalesced': self.num_coalesced,
+                'fallbacks': self.num_fallbacks,
+                'in_flight': len(self.flights)}
+
+    def get_key(self, env):
+        if env.get('REQUEST_METHOD') != 'GET':
+            return None
+
+        if env.get('CONTENT_LENGTH') not in (None, '', '0'):
+            return None
+
+        for name in self.SKIP_HEADERS:
+            if name in env:
+                return None
+
+        if ('no-cache' in env.get('HTTP_CACHE_CONTROL', '') or
+            'no-cache' in env.get('HTTP_PRAGMA', '')):
+            return None
+
+        return (env['REQUEST_URI'],) + tuple(env.get(name) for name in self.KEY_HEADERS)
+
+    def __call__(self, env, start_response, app):
+        key = self.get_key(env)
+        if key is None:
+            return app(env, start_response)
+
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight(self.max_size)
+                self.num_calls += 1
+                reader = None
+            else:
+                # joined while the key is held, before any chunk is dropped
+                reader = flight.join(self.timeout)
+
+        if reader is None:
+            return self.lead(key, flight, env, start_response, app)
+        else:
+            return self.follow(flight, reader, env, start_response, app)
+
+    def is_shared(self, headers):
+        """ Check if a response can be sent to other requests with the same key
+        """
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+
+            elif name == 'cache-control':
+                value = value.lower()
+                if 'private' in value or 'no-store' in value:
+                    return False
+
+            elif name == 'vary':
+                for vary in value.split(','):
+                    vary = 'HTTP_' + vary.strip().upper().replace('-', '_')
+                    if vary != 'HTTP_' and vary not in self.KEY_HEADERS:
+                        return False
+
+        return True
+
+    def lead(self, key, flight, env, start_response, app):
+        def leader_start_response(status, headers, exc_info=None):
+            shared = self.is_shared(headers)
+            if not shared:
+                # new requests call the app themselves
+                self.release(key, flight)
+
+            # before the downstream start_response can modify the headers
+            flight_headers = list(headers)
+
+            write = start_response(status, headers, exc_info)
+            flight.set_headers(status, flight_headers, shared)
+
+            def leader_write(data):
+                if flight.size + len(data) > self.max_size:
+                    self.release(key, flight)
+
+                flight.add(data)
+                return write(data)
+
+            return leader_write
+
+        try:
+            result = app(env, leader_start_response)
+        except Exception:
+            self.finish(key, flight, failed=True)
+            raise
+
+        return self.lead_iter(key, flight, result)
+
+    def lead_iter(self, key, flight, result):
+        finished = False
+
+        try:
+            for data in result:
+                # too large to keep, new requests call the app themselves
+                if flight.size + len(data) > self.max_size:
+                    self.release(key, flight)
+
+                flight.add(data)
+                yield data
+
+            finished = True
+
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+            self.finish(key, flight, failed=not finished)
+
+    def release(self, key, flight):
+        # new requests from now on start a new call
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def finish(self, key, flight, failed=False):
+        self.release(key, flight)
+        flight.finish(failed)
+
+    def follow(self, flight, reader, env, start_response, app):
+        if not flight.wait_headers(self.timeout) or not flight.shared:
+            reader.close()
+
+            with self.lock:
+                self.num_fallbacks += 1
+
+            return app(env, start_response)
+
+        with self.lock:
+            self.num_coalesced += 1
+
+        start_response(flight.status, list(flight.headers))
+        return reader
@@ -0,0 +1,266 @@
+from __future__ import absolute_import
+
+import threading
+import time
+import zlib
+
+
+# per-thread cpu time, where available
+cpu_time = getattr(time, 'thread_time', time.time)
+
+
+# ============================================================================
+def load_brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        pass
+
+    try:
+        import brotlicffi
+        return brotlicffi
+    except ImportError:
+        return None
+
+
+# ============================================================================
+class GzipEncoder(object):
+    __slots__ = ('compressor', 'flush_size', 'pending')
+
+    def __init__(self, level, flush_size=0):
+        # wbits 16 + 15: gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.flush_size = flush_size
+        self.pending = 0
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# ============================================================================
+class BrotliEncoder(object):
+    __slots__ = ('compressor', 'flush_size', 'pending')
+
+    def __init__(self, brotli, quality, flush_size=0):
+        self.compressor = brotli.Compressor(quality=quality)
+        self.flush_size = flush_size
+        self.pending = 0
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+# ============================================================================
+class ResponseCompression(object):
+    """ Opt-in compression of responses sent over a tunnel, negotiated
+    from the request's ``Accept-Encoding``. Brotli is preferred, if the
+    ``brotli`` package is installed and the client accepts it, then gzip.
+
+    Only responses with an allowed content type, and a ``Content-Length``
+    of at least ``min_size`` (or no ``Content-Length``) are compressed.
+    Responses that are already encoded, or marked ``no-transform``
+    are left as is.
+
+    The compressed output is flushed once ``flush_size`` bytes of input
+    are pending, as each flush costs some compression. Responses with a
+    ``STREAM_CONTENT_TYPES`` type are flushed after each app chunk.
+    """
+    DEFAULT_CONTENT_TYPES = ('text/',
+                             'application/javascript',
+                             'application/x-javascript',
+                             'application/json',
+                             'application/ld+json',
+                             'application/manifest+json',
+                             'application/xml',
+                             'application/xhtml+xml',
+                             'application/rss+xml',
+                             'application/atom+xml',
+                             'image/svg+xml')
+
+    # each event must be sent as soon as it is ready
+    STREAM_CONTENT_TYPES = ('text/event-stream',)
+
+    # no body, or a partial body which can't be encoded on its own
+    SKIP_STATUSES = ('1', '204', '206', '304')
+
+    def __init__(self, level=6, brotli_quality=4, min_size=1024,
+                 content_types=None, enable_brotli=True, flush_size=16384):
+
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+        self.flush_size = flush_size
+        self.content_types = tuple(content_types or self.DEFAULT_CONTENT_TYPES)
+
+        self.brotli = load_brotli() if enable_brotli else None
+
+        self.lock = threading.Lock()
+
+        self.num_compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+    @property
+    def ratio(self):
+        """ compressed / uncompressed size, over all compressed responses
+        """
+        if not self.bytes_in:
+            return 1.0
+
+        return float(self.bytes_out) / self.bytes_in
+
+    def get_stats(self):
+        return {'num_compressed': self.num_compressed,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.ratio,
+                'cpu_time': self.cpu_time}
+
+    def select_encoding(self, environ):
+        accept = environ.get('HTTP_ACCEPT_ENCODING')
+        if not accept or environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+
+        accepted = {}
+        for value in accept.lower().split(','):
+            coding, _, params = value.partition(';')
+            qvalue = 1.0
+
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    qvalue = float(params[2:])
+                except ValueError:
+                    qvalue = 0.0
+
+            accepted[coding.strip()] = qvalue
+
+        if self.brotli and accepted.get('br', 0) > 0:
+            return 'br'
+
+        if accepted.get('gzip', 0) > 0:
+            return 'gzip'
+
+        return None
+
+    def check_response(self, statusline, headers):
+        if statusline.startswith(self.SKIP_STATUSES):
+            return False
+
+        content_type = None
+
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return False
+
+            elif name == 'content-type':
+                content_type = value.lower()
+
+            elif name == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    return False
+
+            elif name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+
+        return bool(content_type and content_type.startswith(self.content_types))
+
+    def update_headers(self, headers, encoding):
+        """ Return headers for the encoded response: the length is no
+        longer known up front, caches must vary on the encoding, and the
+        body is no longer byte-for-byte the same as a strong etag's
+        """
+        new_headers = []
+        has_vary = False
+
+        for name, value in headers:
+            lower = name.lower()
+            if lower == 'content-length':
+                continue
+
+            if lower == 'etag' and not value.startswith('W/'):
+                value = 'W/' + value
+
+            elif lower == 'vary':
+                has_vary = True
+                if 'accept-encoding' not in value.lower():
+                    value += ', Accept-Encoding'
+
+            new_headers.append((name, value))
+
+        new_headers.append(('Content-Encoding', encoding))
+
+        if not has_vary:
+            new_headers.append(('Vary', 'Accept-Encoding'))
+
+        return new_headers
+
+    def get_encoder(self, encoding, headers=None):
+        flush_size = self.flush_size
+
+        for name, value in headers or []:
+            if (name.lower() == 'content-type' and
+                value.lower().startswith(self.STREAM_CONTENT_TYPES)):
+                flush_size = 0
+
+        if encoding == 'br':
+            return BrotliEncoder(self.brotli, self.brotli_quality, flush_size)
+        else:
+            return GzipEncoder(self.level, flush_size)
+
+    def encode(self, encoder, data):
+        """ Compress one chunk of app output, flushing the compressor
+        once enough input is pending, so streamed responses are not
+        held back until the end
+        """
+        start = cpu_time()
+        res = encoder.compress(data)
+
+        encoder.pending += len(data)
+        if encoder.pending >= encoder.flush_size:
+            res += encoder.flush()
+            encoder.pending = 0
+
+        self._update(len(data), len(res), cpu_time() - start)
+        return res
+
+    def encode_iter(self, encoder, orig_iter):
+        with self.lock:
+            self.num_compressed += 1
+
+        for data in orig_iter:
+            if data:
+                res = self.encode(encoder, data)
+                if res:
+                    yield res
+
+        start = cpu_time()
+        res = encoder.finish()
+        self._update(0, len(res), cpu_time() - start)
+
+        if res:
+            yield res
+
+    def _update(self, size_in, size_out, elapsed):
+        with self.lock:
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            self.cpu_time += elapsed
@@ -77,6 +77,19 @@ class SSLConnection(object):
         except OpenSSL.SSL.ZeroReturnError:
             return b''
 
+    def recv_into(self, buffer, nbytes=None, flags=None):
+        if not nbytes:
+            nbytes = len(buffer)
+
+        pending = self._connection.pending()
+        if pending:
+            return self._connection.recv_into(buffer, min(pending, nbytes))
+        try:
+            # unexpected eof is returned as b''
+            return self.__iowait(self._connection.recv_into, buffer, nbytes, flags) or 0
+        except OpenSSL.SSL.ZeroReturnError:
+            return 0
+
     def shutdown(self):
         try:
             return self.__iowait(self._connection.shutdown)
@@ -0,0 +1,304 @@
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import six
+
+from wsgiprox.workers import is_gevent_patched
+
+
+logger = logging.getLogger(__file__)
+
+
+# ============================================================================
+class SamplingProfiler(object):
+    """ Low overhead sampling profiler for a live worker.
+
+    While running, a native thread samples the stack of every other thread
+    each ``interval`` seconds. Under gevent, the stack of the hub thread is
+    that of the greenlet running at the time, while samples with only the
+    hub waiting for I/O are counted as idle, not as stacks.
+
+    Stacks are aggregated as counts, and returned by get_collapsed() in the
+    'collapsed' format used by flamegraph.pl, speedscope, etc. At most
+    ``max_stacks`` distinct stacks are kept, further new stacks are only
+    counted in ``num_dropped``.
+    """
+    IDLE_FRAMES = (('hub.py', 'run'),
+                   ('hub.py', 'wait'))
+
+    def __init__(self, interval=0.005, max_stacks=10000, max_depth=64):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+
+        self.stacks = defaultdict(int)
+
+        # code object -> frame label
+        self.labels = {}
+
+        self.num_samples = 0
+        self.num_idle = 0
+        self.num_dropped = 0
+
+        self.running = False
+        self.generation = 0
+        self.thread_ident = None
+        self.started = None
+        self.elapsed = 0.0
+
+        self.lock = threading.Lock()
+
+        if is_gevent_patched():
+            from gevent.monkey import get_original
+            self._start_thread = get_original(six.moves._thread.__name__, 'start_new_thread')
+            self._get_ident = get_original(six.moves._thread.__name__, 'get_ident')
+            self._sleep = get_original('time', 'sleep')
+        else:
+            self._start_thread = None
+            self._get_ident = None
+            self._sleep = time.sleep
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return False
+
+            self.running = True
+            self.started = time.time()
+
+            # any previous sampling thread exits on its next wakeup
+            self.generation += 1
+            generation = self.generation
+
+        # a real thread, even if patched, so it can sample a busy hub
+        if self._start_thread:
+            self._start_thread(self.run, (generation,))
+        else:
+            thread = threading.Thread(target=self.run, args=(generation,))
+            thread.daemon = True
+            thread.start()
+
+        return True
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return False
+
+            self.running = False
+            self.elapsed += time.time() - self.started
+
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.stacks = defaultdict(int)
+            self.num_samples = 0
+            self.num_idle = 0
+            self.num_dropped = 0
+            self.elapsed = 0.0
+            if self.running:
+                self.started = time.time()
+
+    def get_stats(self):
+        elapsed = self.elapsed
+        if self.running:
+            elapsed += time.time() - self.started
+
+        return {'running': self.running,
+                'samples': self.num_samples,
+                'idle': self.num_idle,
+                'dropped': self.num_dropped,
+                'stacks': len(self.stacks),
+                'elapsed': elapsed}
+
+    def run(self, generation):
+        if self._get_ident:
+            self.thread_ident = self._get_ident()
+        else:
+            self.thread_ident = threading.current_thread().ident
+
+        while True:
+            self._sleep(self.interval)
+
+            if not self.running or self.generation != generation:
+                break
+
+            try:
+                self.sample()
+            except Exception as e:  #pragma: no cover
+                logger.debug('Profiler Sample Failed: ' + str(e))
+
+    def sample(self):
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread_ident:
+                continue
+
+            stack = self.get_stack(frame)
+
+            with self.lock:
+                self.num_samples += 1
+
+                if stack is None:
+                    self.num_idle += 1
+
+                elif stack in self.stacks or len(self.stacks) < self.max_stacks:
+                    self.stacks[stack] += 1
+
+                else:
+                    self.num_dropped += 1
+
+    def get_stack(self, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in self.IDLE_FRAMES:
+            return None
+
+        labels = []
+
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self.get_label(frame.f_code))
+            frame = frame.f_back
+
+        labels.reverse()
+        return ';'.join(labels)
+
+    def get_label(self, code):
+        try:
+            return self.labels[code]
+        except KeyError:
+            pass
+
+        label = '{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name)
+        label = label.replace(';', ':').replace(' ', '_')
+        self.labels[code] = label
+        return label
+
+    def get_collapsed(self):
+        """ Sampled stacks, root first, one 'frame;frame;frame count' line each
+        """
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in stacks)
+
+    def dump(self, filename):
+        with open(filename, 'w') as fh:
+            fh.write(self.get_collapsed())
+
+    def install_signal(self, signum, filename):
+        """ Toggle the profiler on signal ``signum``, writing out and
+        resetting the collected stacks to ``filename`` when stopping
+        """
+        import signal
+
+        def toggle(signum, frame):
+            if self.start():
+                return
+
+            self.stop()
+
+            try:
+                self.dump(filename)
+            except Exception as e:
+                logger.debug('Profiler Dump Failed: ' + str(e))
+
+            self.reset()
+
+        signal.signal(signum, toggle)
+
+
+# ============================================================================
+class ProfilerApp(object):
+    """ Admin endpoints for the profiler, mounted as a proxy app:
+
+    * ``/profile/start``, ``/profile/stop``, ``/profile/reset``: POST only
+    * ``/profile/stats``: current stats, as json
+    * ``/profile/collapsed``: stacks in collapsed format
+
+    If ``token`` is set, requests must send it in the ``X-Profiler-Token``
+    header, otherwise only requests from a loopback address are allowed.
+    """
+    ACTIONS = ('/profile/start', '/profile/stop', '/profile/reset')
+    VIEWS = ('/profile/stats', '/profile/collapsed')
+
+    LOOPBACK = ('::1', 'localhost')
+
+    def __init__(self, profiler, token=None):
+        self.profiler = profiler
+        self.token = token
+
+    def __call__(self, env, start_response):
+        path = env.get('PATH_INFO')
+
+        if path not in self.ACTIONS and path not in self.VIEWS:
+            return None
+
+        if not self.is_allowed(env):
+            return self.send_error(start_response, '403 Forbidden')
+
+        if path in self.ACTIONS and env.get('REQUEST_METHOD') != 'POST':
+            return self.send_error(start_response, '405 Method Not Allowed',
+                                   [('Allow', 'POST')])
+
+        if path == '/profile/start':
+            self.profiler.start()
+            buff = self.get_stats()
+
+        elif path == '/profile/stop':
+            self.profiler.stop()
+            buff = self.get_stats()
+
+        elif path == '/profile/reset':
+            self.profiler.reset()
+            buff = self.get_stats()
+
+        elif path == '/profile/stats':
+            buff = self.get_stats()
+
+        else:
+            buff = self.profiler.get_collapsed().encode('utf-8')
+
+            headers = [('Content-Length', str(len(buff))),
+                       ('Content-Type', 'text/plain; charset=utf-8')]
+
+            start_response('200 OK', headers)
+            return [buff]
+
+        headers = [('Content-Length', str(len(buff))),
+                   ('Content-Type', 'application/json')]
+
+        start_response('200 OK', headers)
+        return [buff]
+
+    def is_allowed(self, env):
+        if self.token:
+            token = env.get('HTTP_X_PROFILER_TOKEN') or ''
+            return hmac.compare_digest(token.encode('utf-8'),
+                                       self.token.encode('utf-8'))
+
+        addr = env.get('REMOTE_ADDR') or ''
+        if addr.startswith('::ffff:'):
+            addr = addr[7:]
+
+        return addr.startswith('127.') or addr in self.LOOPBACK
+
+    def send_error(self, start_response, status, headers=None):
+        buff = status.encode('utf-8')
+
+        headers = [('Content-Length', str(len(buff))),
+                   ('Content-Type', 'text/plain; charset=utf-8')] + (headers or [])
+
+        start_response(status, headers)
+        return [buff]
+
+    def get_stats(self):
+        return json.dumps(self.profiler.get_stats()).encode('utf-8')
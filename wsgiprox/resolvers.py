@@ -1,5 +1,13 @@
+from collections import OrderedDict
+
 import base64
+import hashlib
+import hmac
+import os
+import re
 import six
+import threading
+import time
 
 
 # ============================================================================
@@ -15,15 +23,25 @@ class FixedResolver(object):
 class ProxyAuthResolver(object):
     DEFAULT_MSG = 'Please enter prefix path'
 
-    def __init__(self, auth_msg=None):
+    def __init__(self, auth_msg=None, verifier=None,
+                 cache_size=1000, cache_ttl=60):
+
         self.auth_msg = auth_msg or self.DEFAULT_MSG
 
+        if isinstance(verifier, str):
+            verifier = HtpasswdVerifier(verifier)
+
+        self.verifier = verifier
+
+        # Proxy-Authorization value -> (user, is_valid)
+        self.auth_cache = LRUCache(cache_size, ttl=cache_ttl)
+
     def __call__(self, url, env):
         proxy_auth = env.get('HTTP_PROXY_AUTHORIZATION')
 
-        user_pass = self.read_basic_auth(proxy_auth)
+        user, _ = self.check_auth(proxy_auth)
 
-        return '/' + user_pass.split(':')[0] + '/' + url
+        return '/' + user + '/' + url
 
     def require_auth(self, env):
         proxy_auth = env.get('HTTP_PROXY_AUTHORIZATION')
@@ -31,8 +49,29 @@ class ProxyAuthResolver(object):
         if not proxy_auth:
             return self.auth_msg
 
+        _, is_valid = self.check_auth(proxy_auth)
+        if not is_valid:
+            return self.auth_msg
+
         return None
 
+    def check_auth(self, proxy_auth):
+        res = self.auth_cache.get(proxy_auth)
+        if res is not None:
+            return res
+
+        user_pass = self.read_basic_auth(proxy_auth)
+        user, _, password = user_pass.partition(':')
+
+        if self.verifier:
+            is_valid = bool(self.verifier(user, password))
+        else:
+            is_valid = True
+
+        res = (user, is_valid)
+        self.auth_cache.set(proxy_auth, res)
+        return res
+
     def read_basic_auth(self, value):
         user_pass = ''
         parts = value.split(' ', 1)
@@ -45,3 +84,286 @@ class ProxyAuthResolver(object):
 
         return user_pass
 
+
+# ============================================================================
+class HtpasswdVerifier(object):
+    """ Verify user/password against an htpasswd file, reloaded when
+    modified. Supports bcrypt (if the ``bcrypt`` package is installed),
+    ``{SHA}`` and plaintext entries.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.users = {}
+        self._last_mtime = None
+
+    def __call__(self, user, password):
+        self.check_reload()
+
+        hashed = self.users.get(user)
+        if not hashed:
+            return False
+
+        return self.check_password(password, hashed)
+
+    def check_password(self, password, hashed):
+        password = password.encode('utf-8')
+
+        if hashed.startswith(('$2y$', '$2b$', '$2a$')):
+            import bcrypt
+            # bcrypt package only knows the $2b$ prefix
+            hashed = ('$2b$' + hashed[4:]).encode('utf-8')
+            return bcrypt.checkpw(password, hashed)
+
+        if hashed.startswith('{SHA}'):
+            digest = base64.b64encode(hashlib.sha1(password).digest())
+            return hmac.compare_digest(digest, hashed[5:].encode('utf-8'))
+
+        if hashed.startswith('$'):
+            # unsupported scheme (eg. $apr1$ md5 or crypt)
+            return False
+
+        return hmac.compare_digest(password, hashed.encode('utf-8'))
+
+    def check_reload(self):
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError:
+            self.users = {}
+            return
+
+        if mtime == self._last_mtime:
+            return
+
+        users = {}
+        with open(self.filename, 'rt') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                user, _, hashed = line.partition(':')
+                users[user] = hashed
+
+        self.users = users
+        self._last_mtime = mtime
+
+
+# ============================================================================
+class LRUCache(object):
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.cache.pop(key)
+            except KeyError:
+                return default
+
+            if expires is not None and time.time() >= expires:
+                return default
+
+            # re-insert as most recently used
+            self.cache[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        expires = time.time() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (value, expires)
+
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
+
+# ============================================================================
+class HostRoutingResolver(object):
+    """ Route urls to different prefixes based on a table of rules,
+    each a (pattern, prefix) pair:
+
+    - ``example.com``: exact host match
+    - ``.example.com`` or ``*.example.com``: domain and all subdomains
+    - ``re:<regex>``: regex matched against the full url
+
+    Regex rules are checked first, in order, then the host rules, where
+    an exact match beats the most specific (longest) domain match.
+    Urls not matching any rule get ``default_prefix``.
+
+    Rules can also be loaded from ``rules_file``, one ``<pattern> <prefix>``
+    per line, which is reloaded when modified.
+    """
+    EXACT = '='
+    SUFFIX = '*'
+
+    REGEX_PREFIX = 're:'
+
+    def __init__(self, rules=None, rules_file=None,
+                 default_prefix='/',
+                 cache_size=10000,
+                 reload_interval=5):
+
+        self.default_prefix = default_prefix
+        self.rules_file = rules_file
+        self.reload_interval = reload_interval
+
+        self.cache_size = cache_size
+
+        # (trie, url_rx, url_prefixes, host_cache), replaced as a whole
+        self.tables = ({}, None, {}, LRUCache(cache_size))
+
+        self._last_check = 0
+        self._last_mtime = None
+
+        if rules_file:
+            self.reload()
+        else:
+            self.load_rules(rules or [])
+
+    def __call__(self, url, env):
+        if self.rules_file:
+            self.check_reload()
+
+        return self.get_prefix(url) + url
+
+    @property
+    def host_cache(self):
+        return self.tables[3]
+
+    def get_prefix(self, url):
+        # same tables for the whole lookup, even if reloaded meanwhile
+        trie, url_rx, url_prefixes, host_cache = self.tables
+
+        if url_rx:
+            m = url_rx.match(url)
+            if m:
+                return url_prefixes[m.lastgroup]
+
+        host = self.get_host(url)
+
+        prefix = host_cache.get(host)
+        if prefix is None:
+            prefix = self.lookup_host(host, trie)
+            host_cache.set(host, prefix)
+
+        return prefix
+
+    @staticmethod
+    def get_host(url):
+        start = url.find('://')
+        start = start + 3 if start >= 0 else 0
+
+        end = len(url)
+        for sep in '/?#':
+            pos = url.find(sep, start)
+            if 0 <= pos < end:
+                end = pos
+
+        host = url[start:end].rsplit('@', 1)[-1]
+
+        # strip port, but not from an ipv6 address
+        if not host.endswith(']'):
+            host = host.split(':', 1)[0]
+
+        return host.lower()
+
+    def lookup_host(self, host, trie=None):
+        node = trie if trie is not None else self.tables[0]
+        prefix = self.default_prefix
+
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                return prefix
+
+            prefix = node.get(self.SUFFIX, prefix)
+
+        return node.get(self.EXACT, prefix)
+
+    def load_rules(self, rules):
+        trie = {}
+        url_patterns = []
+        url_prefixes = {}
+
+        for pattern, prefix in rules:
+            if pattern.startswith(self.REGEX_PREFIX):
+                name = 'r' + str(len(url_patterns))
+                url_patterns.append('(?P<{0}>{1})'.format(name, pattern[len(self.REGEX_PREFIX):]))
+                url_prefixes[name] = prefix
+                continue
+
+            pattern = pattern.lower()
+
+            if pattern.startswith('*.'):
+                pattern = pattern[1:]
+
+            if pattern.startswith('.'):
+                pattern = pattern[1:]
+                key = self.SUFFIX
+            else:
+                key = self.EXACT
+
+            node = trie
+            for label in reversed(pattern.split('.')):
+                node = node.setdefault(label, {})
+
+            node[key] = prefix
+
+        url_rx = re.compile('|'.join(url_patterns)) if url_patterns else None
+
+        # swap in the new tables, with a new host cache, in one assignment
+        self.tables = (trie, url_rx, url_prefixes, LRUCache(self.cache_size))
+
+    def read_rules_file(self):
+        rules = []
+        with open(self.rules_file, 'rt') as fh:
+            for line in fh:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+
+                parts = line.split()
+                if len(parts) != 2:
+                    continue
+
+                rules.append((parts[0], parts[1]))
+
+        return rules
+
+    def check_reload(self):
+        now = time.time()
+        if now - self._last_check < self.reload_interval:
+            return
+
+        self._last_check = now
+
+        try:
+            mtime = os.path.getmtime(self.rules_file)
+        except OSError:
+            return
+
+        if mtime != self._last_mtime:
+            self.reload()
+
+    def reload(self):
+        self._last_check = time.time()
+        self._last_mtime = os.path.getmtime(self.rules_file)
+        self.load_rules(self.read_rules_file())
@@ -0,0 +1,29 @@
+from __future__ import absolute_import
+
+import select
+
+
+# ============================================================================
+def wait_socket(sock, write=False, timeout=None):
+    """ Wait until ``sock`` is readable (or writable, if ``write``),
+    returning False if not ready within ``timeout`` seconds.
+
+    poll() is used where available, as select() fails for any fd over
+    FD_SETSIZE (1024), which a busy proxy easily reaches. Both are
+    cooperative if patched by gevent.
+    """
+    if not hasattr(select, 'poll'):  #pragma: no cover
+        # eg. windows, where select() is not limited by fd number
+        if write:
+            return bool(select.select([], [sock], [], timeout)[1])
+        else:
+            return bool(select.select([sock], [], [], timeout)[0])
+
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT if write else select.POLLIN)
+
+    # eof and errors are also reported as ready, for the caller to find
+    if timeout is not None:
+        timeout = max(timeout, 0) * 1000
+
+    return bool(poller.poll(timeout))
@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+
+from six.moves import socketserver
+
+import threading
+
+
+# ============================================================================
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """ wsgiref based server running each connection (and so each tunnel)
+    in its own thread, for running wsgiprox without gevent.
+
+    At most ``max_threads`` connections are handled at once, once all are
+    busy new connections wait in the listen backlog.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, app, max_threads=100,
+                 handler_class=None):
+
+        WSGIServer.__init__(self, server_address,
+                            handler_class or TunnelWSGIRequestHandler)
+        self.set_app(app)
+
+        self.thread_slots = threading.BoundedSemaphore(max_threads)
+
+    def process_request(self, request, client_address):
+        self.thread_slots.acquire()
+        try:
+            socketserver.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.thread_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.thread_slots.release()
+
+
+# ============================================================================
+class TunnelServerHandler(ServerHandler):
+    """ Once a CONNECT tunnel is established, wsgiprox writes all responses
+    over the raw socket itself, so nothing more is sent from here.
+    """
+    def is_tunnel(self):
+        return bool(self.environ.get('wsgiprox.connect_host'))
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.is_tunnel():
+            # only kept for logging
+            self.status = status
+            return self.ignore_write
+
+        return ServerHandler.start_response(self, status, headers, exc_info)
+
+    def finish_response(self):
+        if not self.is_tunnel():
+            return ServerHandler.finish_response(self)
+
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+        self.close()
+
+    def ignore_write(self, data):
+        pass
+
+
+# ============================================================================
+class TunnelWSGIRequestHandler(WSGIRequestHandler):
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():
+            return
+
+        handler = TunnelServerHandler(self.rfile, self.wfile,
+                                      self.get_stderr(), self.get_environ(),
+                                      multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+# ============================================================================
+class QuietWSGIRequestHandler(TunnelWSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+# ============================================================================
+def make_threaded_server(app, host='localhost', port=8080, max_threads=100,
+                         quiet=False):
+
+    handler_class = QuietWSGIRequestHandler if quiet else TunnelWSGIRequestHandler
+
+    return ThreadedWSGIServer((host, port), app,
+                              max_threads=max_threads,
+                              handler_class=handler_class)
@@ -0,0 +1,506 @@
+from __future__ import absolute_import
+
+import base64
+import hashlib
+import socket
+import struct
+import threading
+import zlib
+
+import six
+
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+WS_VERSION = '13'
+
+
+# ============================================================================
+class WebSocketError(Exception):
+    def __init__(self, msg, code=1002):
+        super(WebSocketError, self).__init__(msg)
+        self.code = code
+
+
+# ============================================================================
+# Masking
+_xor_tables = {}
+_numpy = None
+
+NUMPY_MIN_SIZE = 4096
+
+
+def _get_xor_table(key):
+    table = _xor_tables.get(key)
+    if table is None:
+        table = _xor_tables[key] = bytes(bytearray(b ^ key for b in range(256)))
+
+    return table
+
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:  #pragma: no cover
+            _numpy = False
+
+    return _numpy
+
+
+def mask_payload(payload, mask):
+    """ XOR payload with the 4-byte mask (masking and unmasking are
+    the same operation). Larger payloads are masked as 32-bit words
+    with numpy, if available. Otherwise, as every 4th byte shares a mask
+    byte, each of the 4 strided slices is masked with a bytes.translate()
+    """
+    size = len(payload)
+    if not size:
+        return b''
+
+    np = _get_numpy() if size >= NUMPY_MIN_SIZE else None
+    if np:
+        words = size // 4
+        key = np.frombuffer(mask, dtype=np.uint32)[0]
+        res = (np.frombuffer(payload, dtype=np.uint32, count=words) ^ key).tobytes()
+
+        tail = size - words * 4
+        if tail:
+            res += mask_payload(payload[words * 4:], mask)
+
+        return res
+
+    payload = bytes(payload)
+    out = bytearray(size)
+    for i, key in enumerate(six.iterbytes(mask)):
+        out[i::4] = payload[i::4].translate(_get_xor_table(key))
+
+    return bytes(out)
+
+
+# ============================================================================
+class PerMessageDeflate(object):
+    """ permessage-deflate extension (RFC 7692), server side
+    """
+    NAME = 'permessage-deflate'
+
+    TAIL = b'\x00\x00\xff\xff'
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False,
+                 server_max_window_bits=15,
+                 client_max_window_bits=15,
+                 compress_level=6,
+                 min_size=64):
+
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+
+        self.compress_level = compress_level
+        self.min_size = min_size
+
+        self.compressor = None
+        self.decompressor = None
+
+        self.response_params = []
+
+    @classmethod
+    def negotiate(cls, extensions):
+        """ Accept the first valid permessage-deflate offer in the
+        Sec-WebSocket-Extensions header, if any.
+        """
+        for offer in extensions.split(','):
+            params = [p.strip() for p in offer.split(';')]
+            if params[0] != cls.NAME:
+                continue
+
+            ext = cls()
+            if ext.accept(params[1:]):
+                return ext
+
+        return None
+
+    def accept(self, params):
+        seen = set()
+
+        for param in params:
+            name, _, value = param.partition('=')
+            name = name.strip()
+            value = value.strip().strip('"')
+
+            if name in seen:
+                return False
+
+            seen.add(name)
+
+            if name == 'server_no_context_takeover' and not value:
+                self.server_no_context_takeover = True
+                self.response_params.append(name)
+
+            elif name == 'client_no_context_takeover' and not value:
+                self.client_no_context_takeover = True
+                self.response_params.append(name)
+
+            elif name == 'server_max_window_bits':
+                # zlib does not support a raw deflate window of 8
+                if not value.isdigit() or not 9 <= int(value) <= 15:
+                    return False
+
+                self.server_max_window_bits = int(value)
+                self.response_params.append(param)
+
+            elif name == 'client_max_window_bits':
+                # without a value, only a hint that the client supports it
+                if not value:
+                    continue
+
+                if not value.isdigit() or not 9 <= int(value) <= 15:
+                    return False
+
+                self.client_max_window_bits = int(value)
+                self.response_params.append(param)
+
+            else:
+                return False
+
+        return True
+
+    @property
+    def response(self):
+        return '; '.join([self.NAME] + self.response_params)
+
+    def compress(self, data):
+        if not self.compressor or self.server_no_context_takeover:
+            self.compressor = zlib.compressobj(self.compress_level,
+                                               zlib.DEFLATED,
+                                               -self.server_max_window_bits)
+
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(self.TAIL):
+            data = data[:-4]
+
+        return data
+
+    def decompress(self, data, max_size=0):
+        if not self.decompressor or self.client_no_context_takeover:
+            self.decompressor = zlib.decompressobj(-self.client_max_window_bits)
+
+        try:
+            data = self.decompressor.decompress(data + self.TAIL, max_size)
+        except zlib.error as e:
+            raise WebSocketError('Invalid compressed data: ' + str(e), 1007)
+
+        if self.decompressor.unconsumed_tail:
+            raise WebSocketError('Message too big', 1009)
+
+        return data
+
+
+# ============================================================================
+def get_handshake_headers(environ, enable_deflate=False):
+    """ Validate a websocket upgrade request and return the headers
+    for the 101 response, along with the negotiated deflate extension
+    (or None). Raises WebSocketError if not a valid upgrade.
+    """
+    if environ.get('REQUEST_METHOD') != 'GET':
+        raise WebSocketError('Upgrade must be a GET')
+
+    if 'upgrade' not in environ.get('HTTP_CONNECTION', '').lower():
+        raise WebSocketError('Missing Connection: Upgrade')
+
+    if environ.get('HTTP_SEC_WEBSOCKET_VERSION') != WS_VERSION:
+        raise WebSocketError('Unsupported websocket version')
+
+    key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '')
+
+    try:
+        if len(base64.b64decode(key.encode('ascii'))) != 16:
+            raise ValueError()
+    except Exception:
+        raise WebSocketError('Invalid Sec-WebSocket-Key')
+
+    accept = base64.b64encode(hashlib.sha1(key.encode('ascii') + WS_GUID).digest())
+
+    headers = [('Upgrade', 'websocket'),
+               ('Connection', 'Upgrade'),
+               ('Sec-WebSocket-Accept', accept.decode('ascii'))]
+
+    protocols = environ.get('HTTP_SEC_WEBSOCKET_PROTOCOL')
+    if protocols:
+        # no way to ask the app, so pick the client's first choice
+        headers.append(('Sec-WebSocket-Protocol', protocols.split(',')[0].strip()))
+
+    deflate = None
+    extensions = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+    if enable_deflate and extensions:
+        deflate = PerMessageDeflate.negotiate(extensions)
+        if deflate:
+            headers.append(('Sec-WebSocket-Extensions', deflate.response))
+
+    return headers, deflate
+
+
+# ============================================================================
+class WebSocket(object):
+    """ Server side of an established websocket connection (RFC 6455),
+    available to the wrapped app as ``env['wsgi.websocket']``.
+
+    Compatible with the gevent-websocket ``WebSocket`` api:
+    ``receive()`` returns the next text (as str) or binary (as bytes)
+    message, or None once closed, ``send()`` sends a message and
+    ``close()`` closes the connection.
+    """
+    OPCODE_CONTINUATION = 0x0
+    OPCODE_TEXT = 0x1
+    OPCODE_BINARY = 0x2
+    OPCODE_CLOSE = 0x8
+    OPCODE_PING = 0x9
+    OPCODE_PONG = 0xa
+
+    VERSION = WS_VERSION
+
+    MAX_CONTROL_SIZE = 125
+
+    DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+    # larger payloads are sent as a separate write instead of copied
+    # into the header
+    SMALL_FRAME_SIZE = 16384
+
+    __slots__ = ('reader', 'writer', 'environ', 'deflate',
+                 'max_message_size', 'closed', 'close_code',
+                 'send_lock')
+
+    def __init__(self, reader, writer, environ=None, deflate=None,
+                 max_message_size=None):
+        self.reader = reader
+        self.writer = writer
+        self.environ = environ
+        self.deflate = deflate
+
+        self.max_message_size = max_message_size or self.DEFAULT_MAX_MESSAGE_SIZE
+
+        self.closed = False
+        self.close_code = None
+
+        self.send_lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self.environ.get('PATH_INFO') if self.environ else None
+
+    @property
+    def origin(self):
+        return self.environ.get('HTTP_ORIGIN') if self.environ else None
+
+    def receive(self):
+        if self.closed:
+            return None
+
+        try:
+            return self.read_message()
+
+        except WebSocketError as e:
+            self.close(e.code, str(e))
+
+        except (socket.error, IOError):
+            self.closed = True
+
+        return None
+
+    def read_exact(self, size):
+        data = self.reader.read(size)
+        if len(data) != size:
+            raise IOError('Unexpected EOF reading websocket frame')
+
+        return data
+
+    def read_frame(self):
+        """ Read one frame, returning (fin, rsv1, opcode, payload)
+        """
+        b0, b1 = struct.unpack('!BB', self.read_exact(2))
+
+        fin = bool(b0 & 0x80)
+        rsv1 = bool(b0 & 0x40)
+        opcode = b0 & 0x0f
+
+        if b0 & 0x30:
+            raise WebSocketError('Reserved bits set')
+
+        if not b1 & 0x80:
+            raise WebSocketError('Client frames must be masked')
+
+        length = b1 & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read_exact(8))[0]
+
+        if opcode >= self.OPCODE_CLOSE:
+            if not fin or length > self.MAX_CONTROL_SIZE:
+                raise WebSocketError('Invalid control frame')
+
+            if rsv1:
+                raise WebSocketError('Compressed control frame')
+
+        elif length > self.max_message_size:
+            raise WebSocketError('Message too big', 1009)
+
+        mask = self.read_exact(4)
+        payload = self.read_exact(length) if length else b''
+
+        return fin, rsv1, opcode, mask_payload(payload, mask)
+
+    def read_message(self):
+        opcode = None
+        compressed = False
+        chunks = []
+        size = 0
+
+        while True:
+            fin, rsv1, frame_opcode, payload = self.read_frame()
+
+            if frame_opcode >= self.OPCODE_CLOSE:
+                self.handle_control(frame_opcode, payload)
+                if self.closed:
+                    return None
+
+                continue
+
+            if frame_opcode == self.OPCODE_CONTINUATION:
+                if opcode is None:
+                    raise WebSocketError('Unexpected continuation frame')
+
+                if rsv1:
+                    raise WebSocketError('RSV1 set on continuation frame')
+
+            elif frame_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
+                if opcode is not None:
+                    raise WebSocketError('Expected continuation frame')
+
+                if rsv1 and not self.deflate:
+                    raise WebSocketError('Compression not negotiated')
+
+                opcode = frame_opcode
+                compressed = rsv1
+
+            else:
+                raise WebSocketError('Unknown opcode {0}'.format(frame_opcode))
+
+            size += len(payload)
+            if size > self.max_message_size:
+                raise WebSocketError('Message too big', 1009)
+
+            chunks.append(payload)
+
+            if fin:
+                break
+
+        message = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+        if compressed:
+            message = self.deflate.decompress(message, self.max_message_size)
+
+        if opcode == self.OPCODE_TEXT:
+            try:
+                return message.decode('utf-8')
+            except UnicodeDecodeError:
+                raise WebSocketError('Invalid utf-8 in text message', 1007)
+
+        return message
+
+    def handle_control(self, opcode, payload):
+        if opcode == self.OPCODE_PING:
+            self.send_frame(payload, self.OPCODE_PONG)
+
+        elif opcode == self.OPCODE_CLOSE:
+            code = 1000
+            if len(payload) >= 2:
+                code = struct.unpack('!H', payload[:2])[0]
+            elif payload:
+                raise WebSocketError('Invalid close frame')
+
+            # codes which must not be sent on the wire
+            if code < 1000 or code in (1004, 1005, 1006, 1015):
+                raise WebSocketError('Invalid close code {0}'.format(code))
+
+            # echo the close code back
+            self.close(code)
+
+        elif opcode != self.OPCODE_PONG:
+            raise WebSocketError('Unknown opcode {0}'.format(opcode))
+
+    def send(self, message, binary=None):
+        if binary is None:
+            binary = not isinstance(message, six.text_type)
+
+        if isinstance(message, six.text_type):
+            message = message.encode('utf-8')
+
+        opcode = self.OPCODE_BINARY if binary else self.OPCODE_TEXT
+        return self.send_frame(message, opcode)
+
+    def send_frame(self, payload, opcode, fin=True):
+        """ Send a single frame. Fragmented messages can be sent as a
+        text or binary frame with fin=False, followed by continuation
+        frames, the last with fin=True.
+        """
+        if self.closed:
+            raise WebSocketError('Websocket is closed')
+
+        # compressed under the lock: with context takeover, the frames
+        # must be sent in the order they were compressed in
+        with self.send_lock:
+            rsv1 = False
+            if (self.deflate and fin and opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY) and
+                len(payload) >= self.deflate.min_size):
+                payload = self.deflate.compress(payload)
+                rsv1 = True
+
+            header = self.encode_header(opcode, len(payload), fin, rsv1)
+
+            if len(payload) < self.SMALL_FRAME_SIZE:
+                self.writer.write(header + payload)
+            else:
+                self.writer.write(header)
+                self.writer.write(payload)
+
+    @staticmethod
+    def encode_header(opcode, length, fin=True, rsv1=False):
+        b0 = opcode
+        if fin:
+            b0 |= 0x80
+        if rsv1:
+            b0 |= 0x40
+
+        # server frames are not masked
+        if length < 126:
+            return struct.pack('!BB', b0, length)
+        elif length < 65536:
+            return struct.pack('!BBH', b0, 126, length)
+        else:
+            return struct.pack('!BBQ', b0, 127, length)
+
+    def ping(self, payload=b''):
+        self.send_frame(payload, self.OPCODE_PING)
+
+    def close(self, code=1000, message=b''):
+        if self.closed:
+            return
+
+        if isinstance(message, six.text_type):
+            message = message.encode('utf-8')
+
+        try:
+            payload = struct.pack('!H', code) + message[:self.MAX_CONTROL_SIZE - 2]
+            self.send_frame(payload, self.OPCODE_CLOSE)
+        except (socket.error, IOError):
+            pass
+
+        finally:
+            self.closed = True
+            self.close_code = code
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import socket
+
+
+# ============================================================================
+def is_gevent_patched():
+    try:
+        import gevent.socket
+        return gevent.socket.socket == socket.socket
+    except ImportError:  #pragma: no cover
+        return False
+
+
+# ============================================================================
+class CryptoWorkers(object):
+    """ Run CPU-heavy crypto (handshakes, cert signing) off the I/O loop.
+
+    Under gevent, work is run in gevent's native thread pool, and the
+    calling greenlet yields until it is done. OpenSSL releases the GIL
+    while working, so this allows using multiple cores for crypto.
+    Without gevent each tunnel already has its own thread, and work is
+    just run inline.
+
+    Cert generation can instead be run in a pool of ``num_processes``
+    processes, for the parts of signing that do hold the GIL.
+    """
+    def __init__(self, num_threads=0, num_processes=0):
+        self.threadpool = None
+        self.process_pool = None
+
+        self.is_gevent = is_gevent_patched()
+
+        if self.is_gevent and num_threads:
+            from gevent.monkey import get_original
+            from gevent.threadpool import ThreadPool
+
+            self.threadpool = ThreadPool(num_threads)
+            self._get_ident = get_original('threading', 'get_ident')
+            self._hub_ident = self._get_ident()
+
+        if num_processes:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # don't fork a process with a running gevent hub
+            context = multiprocessing.get_context('spawn')
+            self.process_pool = ProcessPoolExecutor(num_processes, mp_context=context)
+
+    def run_in_thread(self, func, *args):
+        # already in a worker thread (eg. from a callback)
+        # (an idle ThreadPool is falsy, as it has a __len__)
+        if self.threadpool is None or self._get_ident() != self._hub_ident:
+            return func(*args)
+
+        return self.threadpool.apply(func, args)
+
+    def run_in_process(self, func, *args):
+        if not self.process_pool:
+            return self.run_in_thread(func, *args)
+
+        future = self.process_pool.submit(func, *args)
+
+        if self.threadpool is not None:
+            return self.threadpool.apply(future.result)
+        elif self.is_gevent:
+            # don't block the hub while waiting
+            import gevent
+            return gevent.get_hub().threadpool.apply(future.result)
+        else:
+            return future.result()
+
+    def do_handshake(self, ssl_sock):
+        if self.threadpool is None:
+            return ssl_sock.do_handshake()
+
+        from OpenSSL import SSL
+        from gevent.socket import wait_read, wait_write
+
+        # gevent wrapper: only each handshake step is run in a worker
+        # thread, waiting for the client is done in this greenlet, so a
+        # stalled client doesn't hold on to a worker thread
+        connection = getattr(ssl_sock, '_connection', ssl_sock)
+        fd = connection.fileno()
+        timeout = connection.gettimeout()
+        timeout_exc = socket.timeout('handshake timed out')
+
+        while True:
+            try:
+                return self.threadpool.apply(self._handshake_step, (connection,))
+            except SSL.WantReadError:
+                wait_read(fd, timeout=timeout, timeout_exc=timeout_exc)
+            except SSL.WantWriteError:
+                wait_write(fd, timeout=timeout, timeout_exc=timeout_exc)
+
+    def _handshake_step(self, connection):
+        return connection.do_handshake()
+
+    def close(self):
+        if self.threadpool is not None:
+            self.threadpool.kill()
+
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False)
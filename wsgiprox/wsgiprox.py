@@ -1,57 +1,38 @@
 from __future__ import absolute_import
 
 import socket
-import ssl
 
 from six.moves.urllib.parse import quote, urlsplit
-from tempfile import SpooledTemporaryFile
 
 import six
 import os
+import sys
 import time
 import io
 import logging
+import threading
+import weakref
 
-from certauth.certauth import CertificateAuthority
-
-from OpenSSL import SSL
+# OpenSSL, certauth and the cert modules are only imported once tls
+# interception is first needed, see WSGIProxMiddleware.init_tls()
 
 from wsgiprox.resolvers import FixedResolver
+from wsgiprox.clienthello import peek_client_hello
+from wsgiprox.sockutil import wait_socket
+from wsgiprox.websocket import WebSocket, WebSocketError, get_handshake_headers
+from wsgiprox.accesslog import TimedWriter, LoggedResponse
+from wsgiprox.accesslog import make_record, finish_record, get_status_code, get_content_length
 
 
-try:
-    from geventwebsocket.handler import WebSocketHandler
-except:  #pragma: no cover
-    WebSocketHandler = object
-
 BUFF_SIZE = 16384
 
 logger = logging.getLogger(__file__)
 
 
-# ============================================================================
-class WrappedWebSockHandler(WebSocketHandler):
-    def __init__(self, connect_handler):
-        self.environ = connect_handler.environ
-        self.start_response = connect_handler.start_response
-        self.request_version = 'HTTP/1.1'
-
-        self.socket = connect_handler.curr_sock
-        self.rfile = connect_handler.reader
-
-        class FakeServer(object):
-            def __init__(self):
-                self.application = {}
-
-        self.server = FakeServer()
-
-    @property
-    def logger(self):
-        return logger
-
-
 # ============================================================================
 class BaseHandler(object):
+    __slots__ = ()
+
     FILTER_REQ_HEADERS = ('HTTP_PROXY_CONNECTION',
                           'HTTP_PROXY_AUTHORIZATION')
 
@@ -68,6 +49,7 @@ class BaseHandler(object):
 
     @classmethod
     def buffer_iter(cls, orig_iter, buff_size=65536):
+        from tempfile import SpooledTemporaryFile
         out = SpooledTemporaryFile(buff_size)
         size = 0
 
@@ -89,7 +71,7 @@ class BaseHandler(object):
 
 
 # ============================================================================
-class SocketReader(io.BufferedIOBase):
+class SocketReader(io.RawIOBase):
     def __init__(self, socket):
         self.socket = socket
 
@@ -99,9 +81,378 @@ class SocketReader(io.BufferedIOBase):
     def read(self, size):
         return self.socket.recv(size)
 
+    def readinto(self, buff):
+        # fill caller's buffer directly, avoiding a temp bytes object per read
+        try:
+            return self.socket.recv_into(buff)
+        except Exception as e:
+            # tls close, only possible if pyOpenSSL is loaded
+            SSL = sys.modules.get('OpenSSL.SSL')
+            if SSL and isinstance(e, SSL.ZeroReturnError):
+                return 0
+
+            raise
+
+    def readinto_until(self, buff, deadline):
+        """ readinto(), raising socket.timeout if not done by the deadline,
+        including while waiting for the rest of a partial tls record
+        """
+        orig_timeout = self.socket.gettimeout()
+
+        try:
+            while True:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    raise socket.timeout('read timed out')
+
+                # for tls, set on the tcp socket
+                self.socket.settimeout(timeout)
+
+                try:
+                    return self.readinto(buff)
+
+                except Exception as e:
+                    # only with pyOpenSSL, not patched by gevent
+                    SSL = sys.modules.get('OpenSSL.SSL')
+                    if not SSL or not isinstance(e, (SSL.WantReadError, SSL.WantWriteError)):
+                        raise
+
+                    self.wait_readable(deadline - time.time())
+
+        finally:
+            self.socket.settimeout(orig_timeout)
+
+    def wait_readable(self, timeout=None):
+        """ wait until data or eof is available, raising socket.timeout if
+        not available in time. For tls, waits for any data on the tcp socket,
+        not for a complete record
+        """
+        # already decrypted data waiting
+        if hasattr(self.socket, 'pending') and self.socket.pending():
+            return
+
+        if not wait_socket(self.socket, timeout=timeout):
+            raise socket.timeout('read timed out')
+
+
+# ============================================================================
+class BufferPool(object):
+    __slots__ = ('buff_size', 'max_free', 'free')
+
+    def __init__(self, buff_size=BUFF_SIZE, max_free=64):
+        self.buff_size = buff_size
+        self.max_free = max_free
+        self.free = []
+
+    def acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.buff_size)
+
+    def release(self, buff):
+        if len(self.free) < self.max_free:
+            self.free.append(buff)
+
+
+# ============================================================================
+class RequestHeaderError(Exception):
+    def __init__(self, status, msg):
+        super(RequestHeaderError, self).__init__(msg)
+        self.status = status
+
+
+# ============================================================================
+class HeaderLimits(object):
+    """ Limits on reading the request line and headers in a tunnel,
+    shared by all tunnels, so a slow or malicious client can only hold
+    on to a bounded amount of memory and time before getting an error:
+
+    * ``max_request_line``: max request line length (400)
+    * ``max_header_count``: max number of header lines (431)
+    * ``max_header_bytes``: max size of all header lines (431)
+    * ``header_timeout``: max seconds from the first byte of a request
+      until all headers are read (408), None for no limit
+    """
+    BAD_REQUEST = '400 Bad Request'
+    TOO_LARGE = '431 Request Header Fields Too Large'
+    TIMEOUT = '408 Request Timeout'
+
+    def __init__(self, max_request_line=8192, max_header_count=100,
+                 max_header_bytes=65536, header_timeout=30):
+        self.max_request_line = max_request_line
+        self.max_header_count = max_header_count
+        self.max_header_bytes = max_header_bytes
+        self.header_timeout = header_timeout
+
+        # status -> number of requests rejected
+        self.num_rejected = {}
+
+    def reject(self, status, msg):
+        self.num_rejected[status] = self.num_rejected.get(status, 0) + 1
+        return RequestHeaderError(status, msg)
+
+
+# ============================================================================
+class BufferedSocketReader(object):
+    """ Buffered reader (and wsgi.input) for a tunnel which only holds a
+    buffer, borrowed from a BufferPool, while there is data to be read.
+    release() returns the buffer once it is fully consumed, so idle
+    keep-alive tunnels do not hold on to any read buffer.
+    """
+    __slots__ = ('raw', 'pool', 'buff', 'view', 'pos', 'end', 'deadline')
+
+    def __init__(self, raw, pool):
+        self.raw = raw
+        self.pool = pool
+
+        self.buff = None
+        self.view = None
+        self.pos = 0
+        self.end = 0
+
+        # if set, reads raise socket.timeout if not done by this time
+        self.deadline = None
+
+    def wait_readable(self):
+        if self.pos == self.end:
+            self.raw.wait_readable()
+
+    def _fill(self):
+        if self.buff is None:
+            self.raw.wait_readable(self.deadline - time.time()
+                                   if self.deadline is not None else None)
+            self.buff = self.pool.acquire()
+            self.view = memoryview(self.buff)
+
+        # reset first, in case the read raises
+        self.pos = 0
+        self.end = 0
+
+        if self.deadline is not None:
+            self.end = self.raw.readinto_until(self.buff, self.deadline)
+        else:
+            self.end = self.raw.readinto(self.buff)
+
+        return self.end
+
+    def release(self):
+        if self.buff is not None and self.pos == self.end:
+            self.view.release()
+            self.pool.release(self.buff)
+            self.buff = None
+            self.view = None
+
+    def readline(self, limit=-1):
+        chunks = []
+        total = 0
+
+        while limit < 0 or total < limit:
+            if self.pos == self.end and not self._fill():
+                break
+
+            stop = self.buff.find(b'\n', self.pos, self.end)
+            found = stop >= 0
+            stop = stop + 1 if found else self.end
+
+            if limit >= 0 and total + stop - self.pos > limit:
+                stop = self.pos + limit - total
+                found = False
+
+            chunks.append(self.view[self.pos:stop].tobytes())
+            total += stop - self.pos
+            self.pos = stop
+
+            if found:
+                break
+
+        return b''.join(chunks)
+
+    def readinto(self, buff):
+        view = memoryview(buff)
+        size = len(view)
+        total = 0
+
+        while total < size:
+            avail = self.end - self.pos
+            if avail:
+                avail = min(avail, size - total)
+                view[total:total + avail] = self.view[self.pos:self.pos + avail]
+                self.pos += avail
+                total += avail
+
+            elif size - total >= self.pool.buff_size:
+                # large read, fill caller's buffer directly
+                res = self.raw.readinto(view[total:])
+                if not res:
+                    break
+                total += res
+
+            elif not self._fill():
+                break
+
+        return total
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.pool.buff_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+            return b''.join(chunks)
+
+        # fully buffered, single copy
+        if self.end - self.pos >= size:
+            buff = self.view[self.pos:self.pos + size].tobytes()
+            self.pos += size
+            return buff
+
+        buff = bytearray(size)
+        res = self.readinto(buff)
+        if res < size:
+            del buff[res:]
+
+        return bytes(buff)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+
+            yield line
+
+    def close(self):
+        self.pos = self.end
+        self.release()
+        self.raw.close()
+
+
+# ============================================================================
+class ChunkedReader(object):
+    """ wsgi.input for a chunked request body in a tunnel, with the chunk
+    framing removed, as done by the server for plain http requests.
+    Reads end at the end of the body, leaving the tunnel reader at the
+    start of the next request
+    """
+    MAX_CHUNK_LINE = 1024
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.remaining = 0
+        self.done = False
+
+        # body bytes read, without framing
+        self.num_read = 0
+
+    def _next_chunk(self):
+        line = self.reader.readline(self.MAX_CHUNK_LINE)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError('Invalid Chunk Size: ' + repr(line))
+
+        if size == 0:
+            # skip trailers
+            while True:
+                line = self.reader.readline(self.MAX_CHUNK_LINE)
+                if not line or not line.strip():
+                    break
+
+            self.done = True
+
+        self.remaining = size
+
+    def _end_chunk(self):
+        if self.remaining == 0:
+            self.reader.readline(self.MAX_CHUNK_LINE)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+
+        chunks = []
+
+        while size != 0 and not self.done:
+            if self.remaining == 0:
+                self._next_chunk()
+                continue
+
+            length = self.remaining if size < 0 else min(size, self.remaining)
+            buff = self.reader.read(length)
+            if not buff:
+                raise IOError('Truncated Chunked Body')
+
+            chunks.append(buff)
+            self.remaining -= len(buff)
+            self.num_read += len(buff)
+            if size > 0:
+                size -= len(buff)
+
+            self._end_chunk()
+
+        return b''.join(chunks)
+
+    def readline(self, limit=-1):
+        chunks = []
+
+        while limit != 0 and not self.done:
+            if self.remaining == 0:
+                self._next_chunk()
+                continue
+
+            length = self.remaining if limit < 0 else min(limit, self.remaining)
+            buff = self.reader.readline(length)
+            if not buff:
+                raise IOError('Truncated Chunked Body')
+
+            chunks.append(buff)
+            self.remaining -= len(buff)
+            self.num_read += len(buff)
+            if limit > 0:
+                limit -= len(buff)
+
+            self._end_chunk()
+
+            if buff.endswith(b'\n'):
+                break
+
+        return b''.join(chunks)
+
+    def readinto(self, buff):
+        data = self.read(len(buff))
+        buff[:len(data)] = data
+        return len(data)
+
+    def drain(self):
+        while not self.done:
+            self.read(BUFF_SIZE)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+
+            yield line
+
+    def close(self):
+        pass
+
 
 # ============================================================================
 class SocketWriter(object):
+    __slots__ = ('socket',)
+
     def __init__(self, socket):
         self.socket = socket
 
@@ -109,9 +460,85 @@ class SocketWriter(object):
         return self.socket.sendall(buff)
 
 
+# ============================================================================
+class TunnelRelay(object):
+    def __init__(self, client_sock, upstream_sock, buff_size=BUFF_SIZE):
+        self.client_sock = client_sock
+        self.upstream_sock = upstream_sock
+        self.buff_size = buff_size
+
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+    def run(self):
+        # client -> upstream in a separate thread (greenlet if patched)
+        # upstream -> client in the current one
+        up = threading.Thread(target=self.relay_up)
+        up.daemon = True
+        up.start()
+
+        self.relay_down()
+
+        up.join()
+
+    def relay_up(self):
+        self._relay(self.client_sock, self.upstream_sock, 'bytes_up')
+
+    def relay_down(self):
+        self._relay(self.upstream_sock, self.client_sock, 'bytes_down')
+
+    def _relay(self, src, dst, counter):
+        # single buffer per direction, reused for every recv_into()
+        buff = bytearray(self.buff_size)
+        view = memoryview(buff)
+        total = 0
+
+        try:
+            while True:
+                size = src.recv_into(buff)
+                if not size:
+                    break
+
+                dst.sendall(view[:size])
+                total += size
+                setattr(self, counter, total)
+
+            # clean eof, pass the half-close along
+            self._shutdown(dst, socket.SHUT_WR)
+
+        except Exception as e:
+            logger.debug('Tunnel Relay: ' + str(e))
+
+            # unblock the other direction
+            self._shutdown(src, socket.SHUT_RDWR)
+            self._shutdown(dst, socket.SHUT_RDWR)
+
+    @staticmethod
+    def _shutdown(sock, how):
+        try:
+            sock.shutdown(how)
+        except Exception:
+            pass
+
+
 # ============================================================================
 class ConnectHandler(BaseHandler):
-    def __init__(self, curr_sock, scheme, wsgi, resolve):
+    __slots__ = ('curr_sock', 'scheme', 'wsgi', 'resolve',
+                 'reader', 'writer', 'environ', 'is_keepalive',
+                 'base_environ', 'uri_prefix', 'compression',
+                 'access_log', 'tunnel_id', 'handshake_time', 'num_requests',
+                 'record', 'capture', 'tap', 'closing', 'idle', 'limits',
+                 'backpressure', 'send_writer', '_chunk', '_buffer', '_encoder', 'headers_finished')
+
+    # header name -> environ key (or None if filtered), shared by all tunnels
+    HEADER_KEYS = {}
+
+    MAX_HEADER_KEYS = 1024
+
+    def __init__(self, curr_sock, scheme, wsgi, resolve, buffer_pool=None,
+                 compression=None, access_log=None, tunnel_id=None,
+                 handshake_time=None, capture=None, limits=None,
+                 backpressure=None):
         self.curr_sock = curr_sock
         self.scheme = scheme
 
@@ -119,29 +546,152 @@ class ConnectHandler(BaseHandler):
         self.resolve = resolve
 
         reader = SocketReader(curr_sock)
-        self.reader = io.BufferedReader(reader, BUFF_SIZE)
-        self.writer = SocketWriter(curr_sock)
+        self.reader = BufferedSocketReader(reader, buffer_pool or BufferPool())
+
+        self.backpressure = backpressure
+        if backpressure:
+            self.writer = self.send_writer = backpressure.get_writer(curr_sock)
+        else:
+            self.writer = SocketWriter(curr_sock)
+            self.send_writer = None
+
+        self.base_environ = None
+        self.uri_prefix = None
+
+        self.compression = compression
+
+        self.access_log = access_log
+        self.tunnel_id = tunnel_id
+        self.handshake_time = handshake_time
+        self.num_requests = 0
+        self.record = None
+
+        self.capture = capture
+        self.tap = None
+
+        # close after the current response, when draining
+        self.closing = False
+
+        # waiting for the next request
+        self.idle = True
+
+        self.limits = limits or HeaderLimits()
 
         self.is_keepalive = True
 
-    def __call__(self, environ, enable_ws):
+    def __call__(self, environ, ws_options=None):
         self._chunk = False
         self._buffer = False
+        self._encoder = None
         self.headers_finished = False
 
-        self.convert_environ(environ)
+        self.idle = True
 
+        try:
+            self.convert_environ(environ)
+        except RequestHeaderError as e:
+            logger.debug(str(e))
+            self.send_error(e.status)
+            self.is_keepalive = False
+            return
+
+        self.num_requests += 1
+
+        # deadline starts once the response starts, not while the app runs
+        if self.send_writer:
+            self.send_writer.deadline = None
+
+        if self.access_log:
+            self.handle_logged(ws_options)
+        else:
+            self.handle(ws_options)
+
+        self.is_keepalive = (not self.closing and
+                             self.environ.get('HTTP_CONNECTION', '') == 'keep-alive')
+
+        # don't hold on to the read buffer while waiting for next request
+        self.reader.release()
+
+    def handle(self, ws_options):
         # check for websocket upgrade, if enabled
-        if enable_ws and self.environ.get('HTTP_UPGRADE', '') == 'websocket':
-            self.handle_ws()
+        if (ws_options and
+            self.environ.get('HTTP_UPGRADE', '').lower() == 'websocket'):
+            # websocket frames are not captured
+            if self.tap:
+                self.tap.cancel()
+                self.tap = None
+
+            self.handle_ws(ws_options)
+
+        elif self.tap:
+            self.finish_captured_response()
+
         else:
             self.finish_response()
 
-        self.is_keepalive = self.environ.get('HTTP_CONNECTION', '') == 'keep-alive'
+    def finish_captured_response(self):
+        tap = self.tap
+        writer = self.writer = tap.wrap_writer(self.writer)
+
+        try:
+            self.finish_response()
+
+        except Exception:
+            # only complete responses are captured
+            tap.drop()
+            raise
+
+        finally:
+            self.writer = writer.writer
+            self.tap = None
+
+        tap.finish()
+
+    def handle_logged(self, ws_options):
+        start = time.time()
+
+        self.record = make_record(self.environ, start,
+                                  tunnel=self.tunnel_id,
+                                  index=self.num_requests)
+
+        # handshake only counted once per tunnel
+        if self.num_requests == 1 and self.handshake_time is not None:
+            self.record['handshake_ms'] = round(self.handshake_time * 1000, 3)
+
+        writer = self.writer = TimedWriter(self.writer)
+
+        try:
+            self.handle(ws_options)
+
+        finally:
+            self.writer = writer.writer
+
+            # chunked body size, as read by the app
+            stream = self.environ.get('wsgi.input')
+            if isinstance(stream, ChunkedReader):
+                self.record['req_bytes'] = stream.num_read
+
+            finish_record(self.record, start, writer.bytes, writer.elapsed)
+            self.access_log.log(self.record)
+            self.record = None
 
     def write(self, data):
         self.finish_headers()
-        self.writer.write(data)
+
+        # same encoding and framing as the response iterator, which
+        # also writes the end of the encoded data and the last chunk
+        if self._encoder:
+            data = self.compression.encode(self._encoder, data)
+
+        if not data:
+            return
+
+        if self._chunk:
+            self.writer.write(('%X\r\n' % len(data)).encode())
+            self.writer.write(data)
+            self.writer.write(b'\r\n')
+        else:
+            self.writer.write(data)
 
     def finish_headers(self):
         if not self.headers_finished:
@@ -149,6 +699,23 @@ class ConnectHandler(BaseHandler):
             self.headers_finished = True
 
     def start_response(self, statusline, headers, exc_info=None):
+        if self.record:
+            self.record['status'] = get_status_code(statusline)
+
+        if self.send_writer:
+            self.send_writer.reset_deadline()
+
+        if self.closing:
+            headers = [(name, value) for name, value in headers
+                       if name.lower() != 'connection']
+            headers.append(('Connection', 'close'))
+
+        if self.compression:
+            encoding = self.compression.select_encoding(self.environ)
+            if encoding and self.compression.check_response(statusline, headers):
+                headers = self.compression.update_headers(headers, encoding)
+                self._encoder = self.compression.get_encoder(encoding, headers)
+
         protocol = self.environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
         status_line = protocol + ' ' + statusline + '\r\n'
         self.writer.write(status_line.encode('iso-8859-1'))
@@ -173,9 +740,21 @@ class ConnectHandler(BaseHandler):
 
     def finish_response(self):
         resp_iter = self.wsgi(self.environ, self.start_response)
+
+        # decouple the app from a slow client, if enabled
+        # not if write() was used: it would be called from the spool
+        # thread, interleaved with the sending thread's writes
+        if (self.backpressure and self.backpressure.spool_size and
+            not self.headers_finished and
+            not isinstance(resp_iter, (list, tuple))):
+            resp_iter = self.backpressure.spool(resp_iter)
+
         orig_resp_iter = resp_iter
 
         try:
+            if self._encoder:
+                resp_iter = self.compression.encode_iter(self._encoder, resp_iter)
+
             if self._chunk:
                 resp_iter = self.chunk_encode(resp_iter)
 
@@ -194,29 +773,124 @@ class ConnectHandler(BaseHandler):
             if orig_resp_iter and hasattr(orig_resp_iter, 'close'):
                 orig_resp_iter.close()
 
+    def send_error(self, status):
+        try:
+            self.writer.write(('HTTP/1.1 ' + status + '\r\n'
+                               'Content-Length: 0\r\n'
+                               'Connection: close\r\n\r\n').encode('iso-8859-1'))
+        except Exception as e:
+            logger.debug('Error Response Failed: ' + str(e))
+
     def close(self):
         self.reader.close()
 
-    def handle_ws(self):
-        ws = WrappedWebSockHandler(self)
-        result = ws.upgrade_websocket()
+    def handle_ws(self, ws_options):
+        try:
+            headers, deflate = get_handshake_headers(self.environ,
+                                                     ws_options.get('deflate', False))
+        except WebSocketError as e:
+            logger.debug('Invalid WebSocket Upgrade: ' + str(e))
+            self.writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            if self.record:
+                self.record['status'] = 400
+            self.environ['HTTP_CONNECTION'] = 'close'
+            return
+
+        # not via start_response(), a 101 has no body to be chunked
+        resp = ['HTTP/1.1 101 Switching Protocols\r\n']
+        for name, value in headers:
+            resp.append(name + ': ' + value + '\r\n')
+        resp.append('\r\n')
 
-        # start_response() already called in upgrade_websocket()
-        # flush headers before starting wsgi
-        self.finish_headers()
+        self.writer.write(''.join(resp).encode('iso-8859-1'))
+        self.headers_finished = True
+
+        # no deadline for the lifetime of the websocket
+        if self.send_writer:
+            self.send_writer.deadline = None
+
+        if self.record:
+            self.record['status'] = 101
+
+        ws = WebSocket(self.reader, self.writer, self.environ, deflate,
+                       ws_options.get('max_message_size'))
 
         # wsgi expected to access established 'wsgi.websocket'
+        self.environ['wsgi.websocket'] = ws
+        self.environ['wsgi.websocket_version'] = ws.VERSION
 
         # do-nothing start-response
         def ignore_sr(s, h, e=None):
             return []
 
-        self.wsgi(self.environ, ignore_sr)
+        result = self.wsgi(self.environ, ignore_sr)
+        if hasattr(result, 'close'):
+            result.close()
+
+    def init_base_environ(self, environ):
+        # computed once per tunnel, after the handshake has
+        # settled the connect host
+        base_environ = environ.copy()
+        base_environ['wsgi.url_scheme'] = self.scheme
+
+        uri_prefix = self.scheme + '://' + base_environ['wsgiprox.connect_host']
+        port = base_environ.get('wsgiprox.connect_port', '')
+        if port:
+            uri_prefix += ':' + port
+
+        self.base_environ = base_environ
+        self.uri_prefix = uri_prefix
+
+    @classmethod
+    def get_environ_key(cls, name):
+        try:
+            return cls.HEADER_KEYS[name]
+        except KeyError:
+            pass
+
+        key = name.strip().replace('-', '_').upper()
+
+        if key not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
+            key = 'HTTP_' + key
+
+        if key in cls.FILTER_REQ_HEADERS:
+            key = None
+
+        # don't let arbitrary header names grow the cache forever
+        if len(cls.HEADER_KEYS) < cls.MAX_HEADER_KEYS:
+            cls.HEADER_KEYS[name] = key
+
+        return key
 
     def convert_environ(self, environ):
-        self.environ = environ.copy()
+        if self.base_environ is None:
+            self.init_base_environ(environ)
+
+        self.environ = self.base_environ.copy()
+
+        limits = self.limits
+
+        # wait for the next request, then limit the time to read the headers
+        self.reader.wait_readable()
+        self.idle = False
+
+        if limits.header_timeout is not None:
+            self.reader.deadline = time.time() + limits.header_timeout
 
-        statusline = self.reader.readline().rstrip()
+        try:
+            self.read_head(limits)
+        except socket.timeout:
+            raise limits.reject(limits.TIMEOUT, 'Request Header Timeout')
+        finally:
+            self.reader.deadline = None
+
+    def read_head(self, limits):
+        statusline = self.reader.readline(limits.max_request_line + 1)
+
+        if len(statusline) > limits.max_request_line:
+            raise limits.reject(limits.BAD_REQUEST, 'Request Line Too Long')
+
+        statusline = statusline.rstrip()
 
         if six.PY3:  #pragma: no cover
             statusline = statusline.decode('iso-8859-1')
@@ -227,24 +901,30 @@ class ConnectHandler(BaseHandler):
         if len(statusparts) < 3:
             raise Exception('Invalid Proxy Request Line: length={0} from='.format(len(statusline), hostname))
 
-        self.environ['wsgi.url_scheme'] = self.scheme
-
         self.environ['REQUEST_METHOD'] = statusparts[0]
 
         self.environ['SERVER_PROTOCOL'] = statusparts[2].strip()
 
-        full_uri = self.scheme + '://' + hostname
-        port = self.environ.get('wsgiprox.connect_port', '')
-        if port:
-            full_uri += ':' + port
-
-        full_uri += statusparts[1]
+        full_uri = self.uri_prefix + statusparts[1]
 
         self.resolve(full_uri, self.environ, hostname)
 
+        # raw request line and headers, if capturing
+        head = [statusline.encode('iso-8859-1'), b'\r\n'] if self.capture else None
+
+        header_bytes = 0
+        header_count = 0
+
         while True:
-            line = self.reader.readline()
+            remaining = limits.max_header_bytes - header_bytes
+            line = self.reader.readline(remaining + 1)
+
+            header_bytes += len(line)
+            if header_bytes > limits.max_header_bytes:
+                raise limits.reject(limits.TOO_LARGE, 'Request Headers Too Large')
+
             if line:
+                raw_line = line
                 line = line.rstrip()
                 if six.PY3:  #pragma: no cover
                     line = line.decode('iso-8859-1')
@@ -252,34 +932,66 @@ class ConnectHandler(BaseHandler):
             if not line:
                 break
 
+            header_count += 1
+            if header_count > limits.max_header_count:
+                raise limits.reject(limits.TOO_LARGE, 'Too Many Request Headers')
+
             parts = line.split(':', 1)
             if len(parts) < 2:
                 continue
 
-            name = parts[0].strip()
-            value = parts[1].strip()
+            key = self.get_environ_key(parts[0])
+
+            if key:
+                self.environ[key] = parts[1].strip()
+
+                if head is not None:
+                    head.append(raw_line)
 
-            name = name.replace('-', '_').upper()
+        reader = self.reader
+        chunked = 'chunked' in self.environ.get('HTTP_TRANSFER_ENCODING', '').lower()
 
-            if name not in ('CONTENT_LENGTH', 'CONTENT_TYPE'):
-                name = 'HTTP_' + name
+        if head is not None:
+            head.append(b'\r\n')
 
-            if name not in self.FILTER_REQ_HEADERS:
-                self.environ[name] = value
+            # the body is captured as sent, with any chunk framing
+            self.tap = self.capture.start(full_uri)
+            self.tap.request(b''.join(head))
+            reader = self.tap.wrap_input(reader, get_content_length(self.environ))
 
-        self.environ['wsgi.input'] = self.reader
+        if chunked:
+            reader = ChunkedReader(reader)
+
+            # drained to the end of the chunked body, if not read by the app
+            if self.tap:
+                self.tap.reader = reader
+
+        self.environ['wsgi.input'] = reader
 
 
 # ============================================================================
 class HttpProxyHandler(BaseHandler):
     PROXY_CONN_CLOSE = ('Proxy-Connection', 'close')
+    PROXY_CONN_KEEP_ALIVE = ('Proxy-Connection', 'keep-alive')
+    CONN_CLOSE = ('Connection', 'close')
 
-    def __init__(self, start_response, wsgi, resolve):
+    def __init__(self, start_response, wsgi, resolve, keep_alive=None,
+                 access_log=None, capture=None):
         self.real_start_response = start_response
 
         self.wsgi = wsgi
         self.resolve = resolve
 
+        # True to keep the client connection open, False to close it,
+        # None if the server can't keep connections open anyway
+        self.keep_alive = keep_alive
+
+        self.access_log = access_log
+        self.record = None
+
+        self.capture = capture
+        self.tap = None
+
     def convert_environ(self, environ):
         self.environ = environ
 
@@ -287,20 +999,78 @@ class HttpProxyHandler(BaseHandler):
 
         parts = urlsplit(full_uri)
 
-        self.resolve(full_uri, self.environ, parts.netloc.split(':')[0])
+        self.hostname = parts.netloc.split(':')[0]
+
+        self.resolve(full_uri, self.environ, self.hostname)
 
         for header in list(self.environ.keys()):
             if header in self.FILTER_REQ_HEADERS:
                 self.environ.pop(header, '')
 
     def start_response(self, statusline, headers, exc_info=None):
-        headers.append(self.PROXY_CONN_CLOSE)
+        if self.record:
+            self.record['status'] = get_status_code(statusline)
+
+        if self.keep_alive:
+            headers.append(self.PROXY_CONN_KEEP_ALIVE)
+        else:
+            headers.append(self.PROXY_CONN_CLOSE)
+
+            # also have the server close its side
+            if self.keep_alive is False:
+                headers.append(self.CONN_CLOSE)
 
-        return self.real_start_response(statusline, headers, exc_info)
+        if not self.tap:
+            return self.real_start_response(statusline, headers, exc_info)
+
+        # rebuilt, the server writes the actual status and headers
+        protocol = self.environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
+        self.tap.response_head(protocol, statusline, headers)
+
+        write = self.real_start_response(statusline, headers, exc_info)
+        tap = self.tap
+
+        def tap_write(data):
+            tap.response(data)
+            return write(data)
+
+        return tap_write
 
     def __call__(self, environ):
+        full_uri = environ['REQUEST_URI']
+
         self.convert_environ(environ)
-        return self.wsgi(self.environ, self.start_response)
+
+        if self.capture:
+            self.tap = self.capture.start(full_uri)
+            self.tap.request_head(self.environ, full_uri)
+
+            if 'wsgi.input' in self.environ:
+                self.environ['wsgi.input'] = self.tap.wrap_input(self.environ['wsgi.input'],
+                                                                 get_content_length(self.environ))
+
+        if not self.access_log and not self.tap:
+            return self.wsgi(self.environ, self.start_response)
+
+        start = time.time()
+
+        if self.access_log:
+            self.record = make_record(self.environ, start, host=self.hostname)
+
+        try:
+            result = self.wsgi(self.environ, self.start_response)
+        except Exception:
+            if self.tap:
+                self.tap.drop()
+            raise
+
+        if self.tap:
+            result = self.tap.wrap_response(result)
+
+        if self.access_log:
+            result = LoggedResponse(result, self.record, start, self.access_log)
+
+        return result
 
 
 # ============================================================================
@@ -311,17 +1081,13 @@ class WSGIProxMiddleware(object):
 
     CA_ROOT_FILE = os.path.join('.', 'ca', 'wsgiprox-ca.pem')
 
-    SSL_BASIC_OPTIONS = (
-        SSL.OP_CIPHER_SERVER_PREFERENCE
-    )
+    # set from OpenSSL by set_ssl_options(), unless overridden
+    SSL_BASIC_OPTIONS = None
+    SSL_DEFAULT_METHOD = None
+    SSL_DEFAULT_OPTIONS = None
 
-    SSL_DEFAULT_METHOD = SSL.SSLv23_METHOD
-    SSL_DEFAULT_OPTIONS = (
-        SSL.OP_NO_TICKET |
-        SSL.OP_NO_SSLv2 |
-        SSL.OP_NO_SSLv3 |
-        SSL_BASIC_OPTIONS
-    )
+    SSLConnection = None
+    is_gevent_ssl = False
 
     CONNECT_RESPONSE_1_1 = b'HTTP/1.1 200 Connection Established\r\n\r\n'
 
@@ -329,6 +1095,33 @@ class WSGIProxMiddleware(object):
 
     DEFAULT_MAX_TUNNELS = 50
 
+    DEFAULT_MAX_HTTP_KEEPALIVE = 100
+
+    # servers which close the connection after each response (wsgiref)
+    NO_KEEPALIVE_SERVERS = ('WSGIServer/',)
+
+    DRAIN_POLL_INTERVAL = 0.05
+
+    ALPN_HTTP_1_1 = b'http/1.1'
+
+    @classmethod
+    def set_ssl_options(cls):
+        from OpenSSL import SSL
+
+        if cls.SSL_BASIC_OPTIONS is None:
+            cls.SSL_BASIC_OPTIONS = SSL.OP_CIPHER_SERVER_PREFERENCE
+
+        if cls.SSL_DEFAULT_METHOD is None:
+            cls.SSL_DEFAULT_METHOD = SSL.SSLv23_METHOD
+
+        if cls.SSL_DEFAULT_OPTIONS is None:
+            cls.SSL_DEFAULT_OPTIONS = (
+                SSL.OP_NO_TICKET |
+                SSL.OP_NO_SSLv2 |
+                SSL.OP_NO_SSLv3 |
+                cls.SSL_BASIC_OPTIONS
+            )
+
     @classmethod
     def set_connection_class(cls):
         try:
@@ -351,7 +1144,6 @@ class WSGIProxMiddleware(object):
                  proxy_apps=None):
 
         self._wsgi = wsgi
-        self.set_connection_class()
 
         if isinstance(prefix_resolver, str):
             prefix_resolver = FixedResolver(prefix_resolver)
@@ -368,38 +1160,247 @@ class WSGIProxMiddleware(object):
         # HTTPS Only Options
         proxy_options = proxy_options or {}
 
-        ca_name = proxy_options.get('ca_name', self.CA_ROOT_NAME)
-
-        ca_file_cache = proxy_options.get('ca_file_cache', self.CA_ROOT_FILE)
+        self.proxy_options = proxy_options
 
-        self.ca = CertificateAuthority(ca_name=ca_name,
-                                       ca_file_cache=ca_file_cache,
-                                       cert_cache=None,
-                                       cert_not_before=-3600)
+        # root CA and tls setup, deferred until first needed
+        self._ca = None
+        self._root_ca_file = None
+        self.cert_strategy = None
+        self.crypto_workers = None
+        self.tls_lock = threading.Lock()
 
         self.keepalive_max = proxy_options.get('keepalive_max', self.DEFAULT_MAX_TUNNELS)
+
+        # max requests per plain http proxy connection
+        self.http_keepalive_max = proxy_options.get('http_keepalive_max',
+                                                    self.DEFAULT_MAX_HTTP_KEEPALIVE)
+
+        # client connection socket -> number of requests, dropped with the
+        # socket, so a new connection never inherits an old count
+        self.http_conn_requests = weakref.WeakKeyDictionary()
+        self.num_http_reused = 0
         self.keepalive_opts = hasattr(socket, 'TCP_KEEPIDLE')
 
         self._tcp_keepidle = proxy_options.get('tcp_keepidle', 60)
         self._tcp_keepintvl = proxy_options.get('tcp_keepintvl', 5)
         self._tcp_keepcnt = proxy_options.get('tcp_keepcnt', 3)
 
+        # guards shared counters, when running with threads
+        self.lock = threading.Lock()
+
         self.num_open_tunnels = 0
 
-        try:
-            self.root_ca_file = self.ca.get_root_pem_filename()
-        except Exception as e:
-            self.root_ca_file = None
+        # ConnectHandler -> raw socket, for each open intercepted tunnel
+        self.live_tunnels = {}
+
+        # set by drain(), no new tunnels accepted
+        self.draining = False
+
+        self.buffer_pool = BufferPool(proxy_options.get('buffer_size', BUFF_SIZE),
+                                      proxy_options.get('buffer_pool_max', 64))
+
+        # limits on request headers in intercepted tunnels
+        self.header_limits = HeaderLimits(
+            max_request_line=proxy_options.get('max_request_line', 8192),
+            max_header_count=proxy_options.get('max_header_count', 100),
+            max_header_bytes=proxy_options.get('max_header_bytes', 65536),
+            header_timeout=proxy_options.get('header_timeout', 30))
+
+        # optional features, only imported if enabled
+        self.compression = None
+        if proxy_options.get('enable_compression', False):
+            from wsgiprox.compression import ResponseCompression
+            self.compression = ResponseCompression(
+                level=proxy_options.get('compression_level', 6),
+                brotli_quality=proxy_options.get('brotli_quality', 4),
+                min_size=proxy_options.get('compression_min_size', 1024),
+                flush_size=proxy_options.get('compression_flush_size', 16384),
+                content_types=proxy_options.get('compression_types'))
+
+        self.cache = None
+        if proxy_options.get('enable_cache', False):
+            from wsgiprox.cache import ResponseCache
+            self.cache = ResponseCache(
+                max_memory=proxy_options.get('cache_max_memory', 64 * 1024 * 1024),
+                cache_dir=proxy_options.get('cache_dir'),
+                max_disk=proxy_options.get('cache_max_disk', 1024 * 1024 * 1024),
+                max_entry_size=proxy_options.get('cache_max_entry_size', 8 * 1024 * 1024))
+
+        self.backpressure = None
+        if (proxy_options.get('write_timeout') or proxy_options.get('response_timeout') or
+            proxy_options.get('spool_size') or proxy_options.get('enable_write_stats', False)):
+            from wsgiprox.backpressure import Backpressure
+            self.backpressure = Backpressure(
+                write_timeout=proxy_options.get('write_timeout'),
+                response_timeout=proxy_options.get('response_timeout'),
+                spool_size=proxy_options.get('spool_size', 0))
+
+        self.access_log = proxy_options.get('access_log')
+        if isinstance(self.access_log, str):
+            from wsgiprox.accesslog import AccessLog
+            self.access_log = AccessLog(self.access_log,
+                                        max_size=proxy_options.get('access_log_max_size', 64 * 1024 * 1024),
+                                        backup_count=proxy_options.get('access_log_backups', 5))
+
+        self.num_tunnels = 0
+
+        self.capture = None
+        capture_dir = proxy_options.get('capture_dir')
+        if capture_dir:
+            from wsgiprox.capture import CaptureWriter
+            self.capture = CaptureWriter(capture_dir,
+                                         prefix=proxy_options.get('capture_prefix', 'wsgiprox'),
+                                         max_size=proxy_options.get('capture_max_size', 1024 * 1024 * 1024),
+                                         gzip=proxy_options.get('capture_gzip', True),
+                                         queue_size=proxy_options.get('capture_queue_size', 256))
+
+        self.coalescer = None
+        if proxy_options.get('coalesce_requests', False):
+            from wsgiprox.coalesce import RequestCoalescer
+            self.coalescer = RequestCoalescer(
+                timeout=proxy_options.get('coalesce_timeout', 10),
+                max_size=proxy_options.get('coalesce_max_size', 4 * 1024 * 1024))
 
         self.use_wildcard = proxy_options.get('use_wildcard_certs', True)
 
         if proxy_options.get('enable_cert_download', True):
             download_host = download_host or self.DEFAULT_HOST
-            self.proxy_apps[download_host] = CertDownloader(self.ca)
+            self.proxy_apps[download_host] = CertDownloader(lambda: self.ca)
+
+        self.profiler = None
+        if proxy_options.get('enable_profiler', False):
+            from wsgiprox.profiler import SamplingProfiler, ProfilerApp
+            self.profiler = SamplingProfiler(proxy_options.get('profiler_interval', 0.005))
+
+            if proxy_options.get('profiler_endpoint', False):
+                profiler_host = proxy_options.get('profiler_host', 'wsgiprox-profiler')
+                self.proxy_apps[profiler_host] = ProfilerApp(self.profiler,
+                                                             proxy_options.get('profiler_token'))
+
+            if proxy_options.get('profiler_signal'):
+                self.profiler.install_signal(proxy_options.get('profiler_signal'),
+                                             proxy_options.get('profiler_output', 'wsgiprox-profile.txt'))
+
+        if proxy_options.get('preload_tls', False):
+            self.init_tls()
 
         self.enable_ws = proxy_options.get('enable_websockets', True)
-        if WebSocketHandler == object:
-            self.enable_ws = None
+
+        self.ws_options = None
+        if self.enable_ws:
+            self.ws_options = {'deflate': proxy_options.get('websocket_deflate', False),
+                               'max_message_size': proxy_options.get('websocket_max_message_size')}
+
+        # Pass-through (non-intercepting) tunnels
+        self.passthrough_hosts = set()
+        self.passthrough_suffixes = []
+
+        for host in proxy_options.get('passthrough_hosts', []):
+            if host.startswith('.'):
+                self.passthrough_suffixes.append(host)
+            else:
+                self.passthrough_hosts.add(host)
+
+        self.passthrough_suffixes = tuple(self.passthrough_suffixes)
+        self.passthrough_ports = set(str(port) for port in
+                                     proxy_options.get('passthrough_ports', []))
+
+        self.passthrough_timeout = proxy_options.get('passthrough_connect_timeout', 10)
+
+        # pass-through tunnels via a parent proxy
+        self.parent_proxy = proxy_options.get('parent_proxy')
+        if isinstance(self.parent_proxy, str):
+            from wsgiprox.forward import ParentProxy
+            self.parent_proxy = ParentProxy(self.parent_proxy)
+
+        self.num_passthrough_tunnels = 0
+        self.passthrough_bytes_up = 0
+        self.passthrough_bytes_down = 0
+
+    def drain(self, timeout=None):
+        """ Stop accepting new CONNECT tunnels, close idle tunnels, and
+        close busy ones after their current response.
+
+        Waits until all tunnels, including pass-through tunnels, are closed
+        or ``timeout`` seconds have passed. Returns True if all tunnels
+        were closed
+        """
+        with self.lock:
+            self.draining = True
+            live_tunnels = list(self.live_tunnels.items())
+
+        for connect_handler, raw_sock in live_tunnels:
+            self.close_tunnel(connect_handler, raw_sock)
+
+        deadline = time.time() + timeout if timeout is not None else None
+
+        while self.num_open_tunnels or self.num_passthrough_tunnels:
+            if deadline and time.time() >= deadline:
+                return False
+
+            time.sleep(self.DRAIN_POLL_INTERVAL)
+
+        return True
+
+    def close_tunnel(self, connect_handler, raw_sock):
+        connect_handler.closing = True
+
+        # only waiting for the next request, close now
+        if connect_handler.idle:
+            try:
+                raw_sock.shutdown(socket.SHUT_RDWR)
+            except Exception as e:
+                logger.debug('Tunnel Shutdown Failed: ' + str(e))
+
+    def init_tls(self):
+        """ Load (or create) the root CA and set up tls interception.
+        Done on the first intercepted https tunnel, or can be called
+        ahead of time, eg. before forking workers
+        """
+        if self.cert_strategy:
+            return
+
+        with self.tls_lock:
+            if self.cert_strategy:
+                return
+
+            from certauth.certauth import CertificateAuthority
+            from wsgiprox.certs import WildcardCertStrategy
+
+            self.set_ssl_options()
+            self.set_connection_class()
+
+            proxy_options = self.proxy_options
+
+            self._ca = CertificateAuthority(ca_name=proxy_options.get('ca_name', self.CA_ROOT_NAME),
+                                            ca_file_cache=proxy_options.get('ca_file_cache', self.CA_ROOT_FILE),
+                                            cert_cache=None,
+                                            cert_not_before=-3600)
+
+            try:
+                self._root_ca_file = self._ca.get_root_pem_filename()
+            except Exception as e:
+                self._root_ca_file = None
+
+            # Offload handshakes and cert signing from the I/O loop
+            crypto_threads = proxy_options.get('crypto_threads', 0)
+            cert_processes = proxy_options.get('cert_processes', 0)
+            if crypto_threads or cert_processes:
+                from wsgiprox.workers import CryptoWorkers
+                self.crypto_workers = CryptoWorkers(crypto_threads, cert_processes)
+
+            self.cert_strategy = WildcardCertStrategy(self._ca,
+                                                      workers=self.crypto_workers)
+
+    @property
+    def ca(self):
+        self.init_tls()
+        return self._ca
+
+    @property
+    def root_ca_file(self):
+        self.init_tls()
+        return self._root_ca_file
 
     def wsgi(self, env, start_response):
         # see if the host matches one of the proxy app hosts
@@ -413,7 +1414,20 @@ class WSGIProxMiddleware(object):
                 if res is not None:
                     return res
 
-        # call upstream wsgi app
+        # call upstream wsgi app, through the cache for proxied requests
+        if 'wsgiprox.proxy_host' in env:
+            if self.cache:
+                return self.cache(env, start_response, self.call_upstream)
+
+            return self.call_upstream(env, start_response)
+
+        return self._wsgi(env, start_response)
+
+    def call_upstream(self, env, start_response):
+        # collapse identical concurrent requests, if enabled
+        if self.coalescer:
+            return self.coalescer(env, start_response, self._wsgi)
+
         return self._wsgi(env, start_response)
 
     def __call__(self, env, start_response):
@@ -432,9 +1446,48 @@ class WSGIProxMiddleware(object):
         if res is not None:
             return res
 
-        handler = HttpProxyHandler(start_response, self.wsgi, self.resolve)
+        handler = HttpProxyHandler(start_response, self.wsgi, self.resolve,
+                                   self.check_http_keepalive(env),
+                                   self.access_log,
+                                   self.capture)
         return handler(env)
 
+    def check_http_keepalive(self, env):
+        # server closes after every response, and doesn't allow a
+        # Connection header to be set
+        if env.get('SERVER_SOFTWARE', '').startswith(self.NO_KEEPALIVE_SERVERS):
+            return None
+
+        if self.http_keepalive_max < 0 or self.draining:
+            return False
+
+        conn = (env.get('HTTP_PROXY_CONNECTION') or env.get('HTTP_CONNECTION') or '').lower()
+        if 'close' in conn:
+            return False
+
+        if env.get('SERVER_PROTOCOL') != 'HTTP/1.1' and 'keep-alive' not in conn:
+            return False
+
+        # requests so far on this client connection, not counted if its
+        # socket can't be found (uwsgi creates a new one each time)
+        sock = None if env.get('uwsgi.version') else self.get_raw_socket(env)
+        if sock is None:
+            return True
+
+        with self.lock:
+            count = self.http_conn_requests.get(sock, 0) + 1
+
+            if count > 1:
+                self.num_http_reused += 1
+
+            if self.http_keepalive_max and count >= self.http_keepalive_max:
+                self.http_conn_requests.pop(sock, None)
+                return False
+
+            self.http_conn_requests[sock] = count
+
+        return True
+
     def handle_connect(self, env, start_response):
         raw_sock = self.get_raw_socket(env)
         if not raw_sock:
@@ -442,25 +1495,55 @@ class WSGIProxMiddleware(object):
                            [('Content-Length', '0')])
             return []
 
+        # the server closes the connection after a non-200 CONNECT response
+        if self.draining:
+            start_response('503 Service Unavailable',
+                           [('Content-Length', '0')])
+            return []
+
         res = self.require_auth(env, start_response)
         if res is not None:
             return res
 
+        hostname, port = env['PATH_INFO'].split(':', 1)
+        if self.is_passthrough(hostname, port):
+            return self.handle_passthrough(env, start_response, raw_sock,
+                                           hostname, port)
+
         connect_handler = None
         curr_sock = None
 
         try:
+            start = time.time()
+
             scheme, curr_sock = self.wrap_socket(env, raw_sock)
 
+            with self.lock:
+                self.num_tunnels += 1
+                tunnel_id = self.num_tunnels
+
             connect_handler = ConnectHandler(curr_sock, scheme,
-                                             self.wsgi, self.resolve)
+                                             self.wsgi, self.resolve,
+                                             self.buffer_pool,
+                                             self.compression,
+                                             self.access_log,
+                                             tunnel_id,
+                                             time.time() - start,
+                                             self.capture,
+                                             self.header_limits,
+                                             self.backpressure)
+
+            with self.lock:
+                self.num_open_tunnels += 1
+                self.live_tunnels[connect_handler] = raw_sock
 
-            self.num_open_tunnels += 1
+                # started after drain() was called, only serve one response
+                connect_handler.closing = self.draining
 
-            connect_handler(env, self.enable_ws)
+            connect_handler(env, self.ws_options)
 
             while self.keep_alive(connect_handler):
-                connect_handler(env, self.enable_ws)
+                connect_handler(env, self.ws_options)
 
         except Exception as e:
             logger.debug(str(e))
@@ -470,7 +1553,9 @@ class WSGIProxMiddleware(object):
 
         finally:
             if connect_handler:
-                self.num_open_tunnels -= 1
+                with self.lock:
+                    self.num_open_tunnels -= 1
+                    self.live_tunnels.pop(connect_handler, None)
                 connect_handler.close()
 
             if curr_sock and curr_sock != raw_sock:
@@ -478,6 +1563,8 @@ class WSGIProxMiddleware(object):
                 # in the same gevent
                 try:
                     if self.is_gevent_ssl:
+                        # don't wait forever on a partial record
+                        curr_sock.settimeout(self.header_limits.header_timeout)
                         curr_sock.recv(0)
 
                     curr_sock.shutdown()
@@ -492,12 +1579,88 @@ class WSGIProxMiddleware(object):
 
         return []
 
+    def is_passthrough(self, hostname, port):
+        if port in self.passthrough_ports:
+            return True
+
+        if hostname in self.passthrough_hosts:
+            return True
+
+        if self.passthrough_suffixes:
+            if ('.' + hostname).endswith(self.passthrough_suffixes):
+                return True
+
+        return False
+
+    def handle_passthrough(self, env, start_response, raw_sock, hostname, port):
+        start = time.time()
+
+        try:
+            if self.parent_proxy:
+                upstream_sock = self.parent_proxy.connect(hostname, int(port),
+                                                          self.passthrough_timeout)
+            else:
+                upstream_sock = socket.create_connection((hostname, int(port)),
+                                                         self.passthrough_timeout)
+
+            upstream_sock.settimeout(None)
+        except Exception as e:
+            logger.debug('Passthrough Connect Failed: ' + str(e))
+            start_response('502 Bad Gateway',
+                           [('Content-Length', '0')])
+
+            if self.access_log:
+                self.log_passthrough(env, start, hostname, 502)
+
+            return []
+
+        env['wsgiprox.connect_host'] = hostname
+
+        relay = TunnelRelay(raw_sock, upstream_sock)
+
+        with self.lock:
+            self.num_passthrough_tunnels += 1
+
+        try:
+            raw_sock.sendall(self._get_connect_response(env))
+
+            relay.run()
+
+        except Exception as e:
+            logger.debug(str(e))
+
+        finally:
+            with self.lock:
+                self.num_passthrough_tunnels -= 1
+                self.passthrough_bytes_up += relay.bytes_up
+                self.passthrough_bytes_down += relay.bytes_down
+
+            upstream_sock.close()
+
+            if self.access_log:
+                self.log_passthrough(env, start, hostname, 200, relay)
+
+            start_response('200 OK', [])
+
+        return []
+
+    def log_passthrough(self, env, start, hostname, status, relay=None):
+        record = make_record(env, start, host=hostname)
+        record['status'] = status
+        record['duration_ms'] = round((time.time() - start) * 1000, 3)
+
+        if relay:
+            record['bytes'] = relay.bytes_down
+            record['bytes_up'] = relay.bytes_up
+
+        self.access_log.log(record)
+
     def keep_alive(self, connect_handler):
         # keepalive disabled
         if self.keepalive_max < 0:
             return False
 
-        if not connect_handler.is_keepalive:
+        if not connect_handler.is_keepalive or connect_handler.closing:
             return False
 
         # no max
@@ -507,21 +1670,27 @@ class WSGIProxMiddleware(object):
         return (self.num_open_tunnels <= self.keepalive_max)
 
     def _new_context(self):
+        from OpenSSL import SSL
+
         context = SSL.Context(self.SSL_DEFAULT_METHOD)
         context.set_options(self.SSL_DEFAULT_OPTIONS)
         context.set_session_cache_mode(SSL.SESS_CACHE_OFF)
         return context
 
     def create_ssl_context(self, hostname):
-        cert, key = self.ca.load_cert(hostname,
-                                      wildcard=self.use_wildcard,
-                                      wildcard_use_parent=True)
+        if self.use_wildcard:
+            cert, key = self.cert_strategy.load_cert(hostname)
+        else:
+            cert, key = self.ca.load_cert(hostname)
 
         context = self._new_context()
         context.use_privatekey(key)
         context.use_certificate(cert)
         return context
 
+    def _select_alpn(self, connection, protos):
+        return self.ALPN_HTTP_1_1
+
     def _get_connect_response(self, env):
         if env.get('SERVER_PROTOCOL', 'HTTP/1.0') == 'HTTP/1.1':
             return self.CONNECT_RESPONSE_1_1
@@ -548,16 +1717,26 @@ class WSGIProxMiddleware(object):
 
         if port != '443':
             env['wsgiprox.connect_port'] = port
-            peek_buff = sock.recv(16, socket.MSG_PEEK)
-            # http websocket traffic would start with a GET
-            if peek_buff.startswith(b'GET '):
-                return 'http', sock
+
+        # single peek to decide between plaintext http (eg. websockets)
+        # and tls, and to pick the cert hostname from the sni
+        hello = peek_client_hello(sock)
+        if hello.is_http:
+            return 'http', sock
+
+        env['wsgiprox.tls_alpn'] = hello.alpn
+        env['wsgiprox.tls_versions'] = hello.versions
+
+        self.init_tls()
+
+        # curl -k (unverified) mode results in empty sni hostname
+        # requests unverified mode still includes an sni hostname
+        if hello.sni:
+            env['wsgiprox.connect_host'] = hello.sni
 
         def sni_callback(connection):
             sni_hostname = connection.get_servername()
 
-            # curl -k (unverified) mode results in empty hostname here
-            # requests unverified mode still includes an sni hostname
             if not sni_hostname:
                 return
 
@@ -571,12 +1750,23 @@ class WSGIProxMiddleware(object):
             connection.set_context(self.create_ssl_context(sni_hostname))
             env['wsgiprox.connect_host'] = sni_hostname
 
-        context = self.create_ssl_context(hostname)
-        context.set_tlsext_servername_callback(sni_callback)
+        context = self.create_ssl_context(env['wsgiprox.connect_host'])
+
+        # only if the ClientHello could not be parsed ahead of the handshake
+        if not hello.is_complete:
+            context.set_tlsext_servername_callback(sni_callback)
+
+        if self.ALPN_HTTP_1_1 in hello.alpn:
+            context.set_alpn_select_callback(self._select_alpn)
 
         ssl_sock = self.SSLConnection(context, sock)
         ssl_sock.set_accept_state()
-        ssl_sock.do_handshake()
+
+        # sni callback may need to create certs, so must run in this thread
+        if self.crypto_workers and hello.is_complete:
+            self.crypto_workers.do_handshake(ssl_sock)
+        else:
+            ssl_sock.do_handshake()
 
         return 'https', ssl_sock
 
@@ -667,7 +1857,15 @@ class CertDownloader(object):
     DL_P12 = '/download/p12'
 
     def __init__(self, ca):
-        self.ca = ca
+        self._ca = ca
+
+    @property
+    def ca(self):
+        # a callable, if the ca is only loaded on first use
+        if callable(self._ca):
+            return self._ca()
+
+        return self._ca
 
     def __call__(self, env, start_response):
         path = env.get('PATH_INFO')